@@ -1 +1,2 @@
+set STARCHEAT_LOG_LEVEL=debug
 .\starcheat.exe > .\starcheat_debug.txt 2>&1
\ No newline at end of file
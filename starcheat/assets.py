@@ -2,16 +2,23 @@
 Module for reading and indexing Starbound assets
 """
 
-import os, json, re, sqlite3
-from platform import system
+import os, json, re, sqlite3, functools, threading, posixpath, time, struct, math
+from collections import OrderedDict, namedtuple
 
-import config
-conf = config.Config().read()
+import config, pak, logs, profiling
+
+log = logs.get_logger("assets")
+
+# Regular expression for comments
+comment_re = re.compile(
+    '(^)?[^\S\n]*/(?:\*(.*?)\*/[^\S\n]*|/[^\n]*)($)?',
+    re.DOTALL | re.MULTILINE
+)
 
 # source: http://www.lifl.fr/~riquetd/parse-a-json-file-with-comments.html
-def parse_json(filename):
+def parse_json_content(content):
     """
-    Parse a JSON file
+    Parse a JSON string
     First remove comments and then use the json module package
     Comments look like :
     // ...
@@ -21,175 +28,1262 @@ def parse_json(filename):
     */
     """
 
-    # Regular expression for comments
-    comment_re = re.compile(
-        '(^)?[^\S\n]*/(?:\*(.*?)\*/[^\S\n]*|/[^\n]*)($)?',
-        re.DOTALL | re.MULTILINE
-    )
+    # Looking for comments
+    match = comment_re.search(content)
+    while match:
+        # single line comment
+        content = content[:match.start()] + content[match.end():]
+        match = comment_re.search(content)
 
-    with open(filename) as f:
-        content = ''.join(f.readlines())
+    # Return json file
+    return json.loads(content)
 
-        # Looking for comments
-        match = comment_re.search(content)
-        while match:
-            # single line comment
-            content = content[:match.start()] + content[match.end():]
-            match = comment_re.search(content)
+def asset_path(folder, path):
+    """Resolve an asset path relative to an asset folder. Absolute paths are left alone."""
+    if path.startswith("/"):
+        return path
+    return posixpath.join(folder, path)
+
+class AssetSource():
+    """Common base for places assets can be read from."""
+    def read_json(self, path):
+        """Read and parse a JSON asset, see parse_json_content."""
+        return parse_json_content(self.read(path).decode("utf-8-sig"))
+
+    def changed(self):
+        """Return True if the source needs to be opened again to see its current contents."""
+        return False
+
+class FolderSource(AssetSource):
+    def __init__(self, folder):
+        """Assets that have been unpacked to a regular folder."""
+        self.folder = folder
+
+    def full_path(self, path):
+        return os.path.join(self.folder, *path.strip("/").split("/"))
+
+    def scan(self, folder="/"):
+        """Return (asset path, size, mtime) for every file below an asset folder."""
+        found = []
+        folder = folder.rstrip("/")
+        pending = [(self.full_path(folder), folder)]
+        while len(pending) > 0:
+            real_folder, folder = pending.pop()
+            try:
+                entries = os.scandir(real_folder)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    path = folder + "/" + entry.name
+                    if entry.is_dir():
+                        pending.append((entry.path, path))
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        found.append((path, stat.st_size, stat.st_mtime))
+        return found
+
+    def files(self, folder="/"):
+        """Return every asset path below a given asset folder."""
+        return [x[0] for x in self.scan(folder)]
+
+    def exists(self, path):
+        return os.path.isfile(self.full_path(path))
+
+    def mtime(self, path):
+        """Return when an asset was last modified."""
+        return os.stat(self.full_path(path)).st_mtime
+
+    def read(self, path, size=-1):
+        """Return the contents of an asset as bytes, or only the first size bytes."""
+        with open(self.full_path(path), "rb") as f:
+            return f.read(size)
+
+class PakSource(AssetSource):
+    def __init__(self, filename):
+        """Assets read straight out of a Starbound .pak archive."""
+        self.filename = filename
+        self.pak = pak.PakFile(filename)
+        # files in an archive don't have their own mtime
+        stat = os.stat(filename)
+        self.pak_mtime = stat.st_mtime
+        self.pak_size = stat.st_size
+
+    def scan(self, folder="/"):
+        """Return (asset path, size, mtime) for every file below an asset folder."""
+        prefix = folder.rstrip("/") + "/"
+        return [(f, self.pak.size(f), self.pak_mtime) for f in self.pak.files() if f.startswith(prefix)]
+
+    def files(self, folder="/"):
+        """Return every asset path below a given asset folder."""
+        prefix = folder.rstrip("/") + "/"
+        return [f for f in self.pak.files() if f.startswith(prefix)]
+
+    def exists(self, path):
+        return self.pak.exists(path)
+
+    def mtime(self, path):
+        """Return when an asset was last modified (when the archive was)."""
+        return self.pak_mtime
+
+    def read(self, path, size=-1):
+        """Return the contents of an asset as bytes, or only the first size bytes."""
+        try:
+            return self.pak.read(path, size)
+        except KeyError:
+            raise FileNotFoundError(path)
+
+    def changed(self):
+        # the index and map are only read when the archive is opened
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return stat.st_mtime != self.pak_mtime or stat.st_size != self.pak_size
+
+def open_source(path):
+    """
+    Return the right asset source for a path. It can be a .pak file, a
+    folder with a packed.pak in it or a folder of unpacked assets.
+    """
+    packed = os.path.join(path, "packed.pak")
+    if os.path.isfile(path):
+        return PakSource(path)
+    elif not os.path.isdir(os.path.join(path, "items")) and os.path.isfile(packed):
+        return PakSource(packed)
+    else:
+        return FolderSource(path)
+
+# top level asset folders that get searched for indexable files
+asset_roots = ("items", "objects", "tech", "recipes")
+
+# what each file gets indexed as, by top level folder and file extension
+asset_kinds = {
+    ("objects", "object"): "item",
+    ("tech", "techitem"): "item",
+    ("recipes", "recipe"): "blueprint"
+}
+
+# anything in the items folder is an item, except for these
+ignored_item_types = frozenset(("png", "config", "frames", "coinitem", "lua", "animation", "wav", "ogg"))
+
+class Discovery(namedtuple("Discovery", ("items", "blueprints", "seconds"))):
+    """
+    Indexable files found in an asset source. items and blueprints are lists
+    of (asset path, size, mtime), seconds is how long the search took.
+    """
+    def signature(self):
+        """Return a string that changes whenever the discovered files change."""
+        files = self.items + self.blueprints
+        newest = max([x[2] for x in files] + [0])
+        return "%d:%d:%f" % (len(files), sum([x[1] for x in files]), newest)
+
+    def fingerprint(self):
+        """
+        Return a string identifying the discovered files that, unlike the
+        signature, stays the same across machines (no modified times).
+        """
+        files = self.items + self.blueprints
+        return "%d:%d" % (len(files), sum([x[1] for x in files]))
+
+class LayerChanges(namedtuple("LayerChanges", ("reindexed", "dropped", "reordered"))):
+    """Names of the layers AssetsDb.update_layers reindexed, dropped and reordered."""
+    def changed(self):
+        return len(self.reindexed) + len(self.dropped) + len(self.reordered) > 0
+
+@profiling.timed("index.discover")
+def discover_assets(source):
+    """Walk each asset root of a source once and sort out every indexable file."""
+    start = time.perf_counter()
+    found = {"item": [], "blueprint": []}
+    for root in asset_roots:
+        for entry in source.scan("/" + root):
+            ext = entry[0].rpartition(".")[2]
+            kind = asset_kinds.get((root, ext))
+            if kind is None and root == "items" and ext not in ignored_item_types:
+                kind = "item"
+            if kind is not None:
+                found[kind].append(entry)
+
+    discovery = Discovery(found["item"], found["blueprint"], time.perf_counter() - start)
+    log.info("Discovered %d item and %d blueprint files in %.2fs",
+             len(discovery.items), len(discovery.blueprints), discovery.seconds)
+    return discovery
+
+def get_layers(assets_folder=None, mods=None):
+    """
+    Return the configured asset layers as (name, path) pairs, lowest priority
+    first. The base game assets always come first and each mod overrides
+    everything before it. assets_folder and the list of mods override the
+    config settings.
+    """
+    conf = config.Config().read()
+    if assets_folder is None:
+        assets_folder = conf["assets_folder"]
+    if mods is None:
+        mods = conf["mod_assets_folder"].split(os.pathsep)
+
+    layers = [("base", assets_folder)]
+    for path in mods:
+        if path.strip() == "":
+            continue
+        name = os.path.basename(os.path.normpath(path))
+        # two mods can easily have the same folder name
+        names = [x[0] for x in layers]
+        unique = name
+        while unique in names:
+            unique += "_"
+        layers.append((unique, path))
+    return layers
+
+sources = {}
+sources_lock = threading.Lock()
+
+def get_source(path):
+    """Return a shared asset source for a path, opening it on first use."""
+    with sources_lock:
+        if path not in sources:
+            sources[path] = open_source(path)
+        return sources[path]
+
+def refresh_sources():
+    """
+    Forget shared asset sources that changed on disk (like a patched
+    packed.pak) so they're opened again on next use. They aren't closed,
+    background threads might still be reading from them, the old map goes
+    away once the last of them is done with it.
+    """
+    with sources_lock:
+        for path in [x for x in sources.keys() if sources[x].changed()]:
+            del sources[path]
+
+def image_size(source, path):
+    """Return the (width, height) of a PNG asset from its header, or None."""
+    header = source.read(path, 24)
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+def parse_frames(info):
+    """
+    Return a dict of frame name to (x, y, w, h) from a parsed .frames file.
+    Like the game, rects are measured from the bottom left of the image.
+    """
+    rects = {}
+
+    if "frameGrid" in info:
+        grid = info["frameGrid"]
+        w, h = grid["size"]
+        columns, rows = grid["dimensions"]
+        begin = grid.get("begin", [0, 0])
+        names = grid.get("names")
+        for y in range(rows):
+            for x in range(columns):
+                if names is None:
+                    name = str(y * columns + x)
+                else:
+                    try:
+                        name = names[y][x]
+                    except IndexError:
+                        name = None
+                # grids go top to bottom, so flip the rows
+                if name is not None:
+                    rects[name] = (begin[0] + x * w, begin[1] + (rows - y - 1) * h, w, h)
+
+    for name, rect in info.get("frameList", {}).items():
+        rects[name] = (rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1])
+
+    for alias, name in info.get("aliases", {}).items():
+        if name in rects:
+            rects[alias] = rects[name]
+
+    return rects
+
+class FramesCache():
+    def __init__(self, sources):
+        """
+        Resolves frame selectors (like icons.png:chest) to image rects using
+        the .frames files in a list of asset sources, highest priority first.
+        That's the layer being indexed and every layer below it, mods usually
+        point at images from the base assets. Parsed files are kept around so
+        a default.frames shared by a whole folder only gets read once.
+        """
+        self.sources = sources
+        self.frames = {}
+
+    def find_source(self, path):
+        """Return the highest priority source containing an asset, or None."""
+        for source in self.sources:
+            if source.exists(path):
+                return source
+        return None
+
+    def load(self, path):
+        """Return the parsed rects of a .frames file, None if it doesn't exist."""
+        if path not in self.frames:
+            source = self.find_source(path)
+            self.frames[path] = None
+            if source is not None:
+                try:
+                    self.frames[path] = parse_frames(source.read_json(path))
+                except (ValueError, KeyError, TypeError):
+                    pass
+        return self.frames[path]
+
+    def find(self, image):
+        """
+        Return the frames for an image. Same lookup as the game, first
+        <image>.frames, then default.frames in the same folder and up.
+        """
+        folder, filename = posixpath.split(image)
+        frames = self.load(posixpath.join(folder, filename.rpartition(".")[0] + ".frames"))
+        while frames is None:
+            frames = self.load(posixpath.join(folder, "default.frames"))
+            if folder == "/":
+                break
+            folder = posixpath.dirname(folder)
+        return frames
 
-        # Return json file
-        return json.loads(content)
+    def resolve(self, folder, value):
+        """
+        Take an image value from an asset file (relative to folder) and return
+        the image path and its (x, y, w, h) rect from the top left. Without
+        a frame the rect is None when the size can't be worked out, use the
+        whole image then. The image is None if a frame was asked for that
+        can't be found, showing the whole sheet would be wrong.
+        """
+        # image directives aren't supported yet, drop them
+        image, _, frame = value.partition("?")[0].partition(":")
+        image = asset_path(folder, image)
+
+        source = self.find_source(image)
+        size = None
+        if source is not None:
+            size = image_size(source, image)
+        if size is None:
+            if frame == "":
+                return image, None
+            return None, None
+        if frame == "":
+            return image, (0, 0) + size
+
+        frames = self.find(image)
+        if frames is None or frame not in frames:
+            return None, None
+        x, y, w, h = frames[frame]
+        return image, (x, size[1] - y - h, w, h)
+
+class LookupCache():
+    def __init__(self, size=4096):
+        """
+        Size bounded LRU cache for asset lookups, shared by the whole process.
+        Background threads use it too so everything happens under a lock.
+        generation goes up every time it's cleared.
+        """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a cached value and mark it recently used. Raises KeyError."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        """
+        Add a value to the cache. If generation is given and the cache has
+        been cleared since, the value is stale and gets dropped.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = value
+            # drop the least recently used entries
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+lookup_cache = LookupCache()
+
+def cached_lookup(func):
+    """
+    Decorator for asset lookup methods. Results are stored in the shared
+    lookup_cache, keyed on class, method and arguments. Exceptions (like
+    missing items) are not cached, neither are results from a lookup that
+    was still running when the database changed.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        key = (self.__class__.__name__, func.__name__) + args
+        try:
+            value = lookup_cache.get(key)
+            profiling.count("asset lookup cache hits")
+            return value
+        except KeyError:
+            profiling.count("asset lookup cache misses")
+            generation = lookup_cache.generation
+            value = func(self, *args)
+            lookup_cache.put(key, value, generation)
+            return value
+    return wrapper
+
+# bump this whenever the database layout changes, old databases will be
+# rebuilt automatically
+db_version = 8
+
+# every item and blueprint row is tagged with the layer it came from. when the
+# same name shows up in more than one layer only the row from the highest
+# priority layer is active
+tables = (
+    "create table layers (name text primary key, path text, priority integer, signature text)",
+    # icon and image rects are resolved from .frames files when indexing,
+    # they're null if the whole image should be used
+    """create table items (name text, filename text, folder text, icon text, category text,
+                           layer text, active integer,
+                           icon_x integer, icon_y integer, icon_w integer, icon_h integer,
+                           image text, image_x integer, image_y integer, image_w integer, image_h integer,
+                           description text, rarity text, max_stack integer, price integer, race text,
+                           trigrams integer, id integer primary key)""",
+    "create table item_tags (item text, tag text, layer text)",
+    # search index over item names and descriptions, see trigrams(). item is
+    # the item's id so postings for a trigram are stored together
+    """create table item_trigrams (trigram text, item integer, layer text,
+                                   primary key (trigram, item)) without rowid""",
+    "create table blueprints (name text, filename text, folder text, category text, layer text, active integer)",
+    # what goes into and comes out of each blueprint
+    "create table recipe_inputs (blueprint text, item text, count integer, layer text)",
+    "create table recipe_outputs (blueprint text, item text, count integer, layer text)"
+)
+
+# tables with rows tagged by layer
+layer_tables = ("items", "item_tags", "item_trigrams", "blueprints", "recipe_inputs", "recipe_outputs")
+
+# created after the bulk insert, it's much faster than updating them per row
+indexes = (
+    "create index items_name on items (name)",
+    # the browser lists page through these in order
+    "create index items_list on items (active, name collate nocase)",
+    "create index items_category on items (category)",
+    "create index items_layer on items (layer)",
+    "create index items_rarity on items (rarity)",
+    "create index items_price on items (price)",
+    "create index items_max_stack on items (max_stack)",
+    "create index item_tags_tag on item_tags (tag)",
+    "create index item_tags_item on item_tags (item, layer)",
+    "create index item_trigrams_layer on item_trigrams (layer)",
+    "create index blueprints_name on blueprints (name)",
+    "create index blueprints_list on blueprints (active, name collate nocase)",
+    "create index blueprints_category on blueprints (category)",
+    "create index blueprints_layer on blueprints (layer)",
+    "create index recipe_inputs_item on recipe_inputs (item)",
+    "create index recipe_inputs_blueprint on recipe_inputs (blueprint, layer)",
+    "create index recipe_outputs_item on recipe_outputs (item)",
+    "create index recipe_outputs_blueprint on recipe_outputs (blueprint, layer)"
+)
+
+# mark the highest priority row for each name as active
+resolve_overrides = (
+    """update items set active = (
+           (select priority from layers where layers.name = items.layer) =
+           (select max(l.priority) from items i join layers l on i.layer = l.name
+            where i.name = items.name))""",
+    """update blueprints set active = (
+           (select priority from layers where layers.name = blueprints.layer) =
+           (select max(l.priority) from blueprints b join layers l on b.layer = l.name
+            where b.name = blueprints.name))"""
+)
+
+# only used while building, the build file is thrown away if anything goes
+# wrong so there's no point paying for a journal or syncing
+build_pragmas = (
+    "pragma journal_mode=off",
+    "pragma synchronous=off",
+    "pragma locking_mode=exclusive",
+    "pragma temp_store=memory",
+    "pragma cache_size=-65536"
+)
+
+# bump this when the snapshot metadata changes
+snapshot_format = 1
+
+class IndexCancelled(Exception):
+    pass
+
+class SnapshotError(Exception):
+    pass
+
+class QueryCancelled(Exception):
+    pass
+
+class IndexProgress():
+    def __init__(self, callback=None):
+        """
+        Progress of an asset index build. callback gets called with this
+        object every so often while indexing, call cancel() from any thread
+        to stop the build.
+        """
+        self.callback = callback
+        self.discovered = 0
+        self.parsed = 0
+        self.failed = 0
+        self.rows = 0
+        # icon thumbnails, the GUI makes those after indexing
+        self.icons = 0
+        self.icons_total = 0
+        self.cancelled = False
+        self.start = time.perf_counter()
+        self.last_report = 0
+
+    def eta(self):
+        """Return the estimated number of seconds left, or None if unknown."""
+        done = self.parsed + self.failed
+        if done == 0:
+            return None
+        rate = (time.perf_counter() - self.start) / done
+        return max(0, self.discovered - done) * rate
+
+    def file_done(self, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.parsed += 1
+        self.report()
+
+    def report(self, force=False):
+        """Send progress to the callback (at most 10 times a second) and check for cancelling."""
+        if self.cancelled:
+            raise IndexCancelled("Asset indexing was cancelled")
+        now = time.perf_counter()
+        if self.callback is not None and (force or now - self.last_report > 0.1):
+            self.last_report = now
+            self.callback(self)
+
+    def cancel(self):
+        self.cancelled = True
 
 class AssetsDb():
-    def __init__(self):
-        """Master assets database."""
-        self.assets_db = config.Config().read()["assets_db"]
+    def __init__(self, filename=None, layers=None):
+        """
+        Master assets database. There should only be one of these per process,
+        use get_assets_db() instead of creating it directly.
+
+        Reads check out a read only connection from a small pool so background
+        threads and the GUI can query at the same time. The database runs in
+        WAL mode so readers never block on writers.
+
+        layers overrides the configured asset layers, see get_layers().
+        """
+        if filename is None:
+            filename = config.Config().read()["assets_db"]
+        self.assets_db = filename
+        self.layers = layers
+        self.pool_size = 4
+
+        self.pool = threading.Condition()
+        self.idle_readers = []
+        self.open_readers = 0
+        # set while the database file is being replaced, no new readers
+        # can be opened on the old file then
+        self.swapping = False
+
+        # queries just come back empty until there's a usable database
+        self.ready = not self.needs_build()
+
+    def get_layers(self):
+        """Return the asset layers this database indexes, lowest priority first."""
+        if self.layers is not None:
+            return self.layers
+        return get_layers()
+
+    def needs_build(self):
+        """Return True if the database is missing or out of date."""
+        return not os.path.isfile(self.assets_db) or self.get_version() != db_version
+
+    def refresh(self, progress=None):
+        """
+        Build the database if needed, otherwise bring the layers up to date,
+        including mods that changed in place. Discovery is cheap enough to
+        check every layer's files each time.
+        """
+        if self.needs_build():
+            self.init_db(progress)
+        else:
+            self.update_layers(check_changes=True, progress=progress)
+
+    def connect_reader(self):
+        # urllib.request is slow to import and this is the only thing using it
+        from urllib.request import pathname2url
+        uri = "file:" + pathname2url(os.path.abspath(self.assets_db)) + "?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def checkout_reader(self):
+        """Take a read only connection from the pool, opening one if needed."""
+        with self.pool:
+            while True:
+                if self.swapping:
+                    self.pool.wait()
+                    continue
+                if len(self.idle_readers) > 0:
+                    return self.idle_readers.pop()
+                if self.open_readers < self.pool_size:
+                    self.open_readers += 1
+                    break
+                self.pool.wait()
+
+        try:
+            return self.connect_reader()
+        except sqlite3.Error:
+            with self.pool:
+                self.open_readers -= 1
+                self.pool.notify()
+            raise
+
+    def checkin_reader(self, conn):
+        with self.pool:
+            self.idle_readers.append(conn)
+            self.pool.notify_all()
+
+    def query(self, q, args=(), one=False, cancel=None):
+        """
+        Run a read query on a pooled connection and return the result.
+        cancel is an optional threading.Event, setting it from another thread
+        stops the query and raises QueryCancelled.
+        """
+        if not self.ready:
+            # still being built
+            if one:
+                return None
+            else:
+                return []
+
+        conn = self.checkout_reader()
+        try:
+            if cancel is not None:
+                # sqlite checks this every few thousand instructions
+                conn.set_progress_handler(cancel.is_set, 1000)
+            with profiling.stage("db.query"):
+                c = conn.execute(q, args)
+                if one:
+                    return c.fetchone()
+                else:
+                    return c.fetchall()
+        except sqlite3.OperationalError:
+            if cancel is not None and cancel.is_set():
+                raise QueryCancelled("Query was cancelled")
+            raise
+        finally:
+            if cancel is not None:
+                conn.set_progress_handler(None, 0)
+            self.checkin_reader(conn)
+
+    def close(self):
+        """Close every connection. They will be reopened on next use."""
+        with self.pool:
+            # wait for any readers still in use to come back
+            while len(self.idle_readers) < self.open_readers:
+                self.pool.wait()
+            for conn in self.idle_readers:
+                conn.close()
+            self.idle_readers = []
+            self.open_readers = 0
+
+    def init_db(self, progress=None):
+        """
+        Build a brand new assets database and swap it into place.
+
+        Everything is bulk loaded into a separate build file on a single
+        connection inside one transaction, with journaling and syncing turned
+        off. Indexes are only created once all the rows are in. The build
+        file replaces the real database in one step at the end, so a
+        cancelled or failed build never leaves a half finished db behind.
+
+        progress is an optional IndexProgress for reporting and cancelling.
+        """
+        if progress is None:
+            progress = IndexProgress()
+        # archives may have been patched since they were opened
+        refresh_sources()
+
+        build_file = self.assets_db + ".build"
+        if os.path.isfile(build_file):
+            os.remove(build_file)
+
+        db = sqlite3.connect(build_file, isolation_level=None)
         try:
-            open(self.assets_db)
-        except FileNotFoundError:
-            self.init_db()
+            for q in build_pragmas:
+                db.execute(q)
+
+            db.execute("begin")
+            for q in tables:
+                db.execute(q)
+            layers = self.get_layers()
+            for priority in range(len(layers)):
+                name, path = layers[priority]
+                self.index_layer(db, name, path, priority, progress)
+            for q in indexes:
+                db.execute(q)
+            for q in resolve_overrides:
+                db.execute(q)
+            db.execute("commit")
+
+            db.execute("analyze")
+            db.execute("pragma user_version = %d" % db_version)
+            db.execute("pragma journal_mode=wal")
+            db.close()
+            progress.report(True)
+        except BaseException:
+            db.close()
+            os.remove(build_file)
+            raise
+
+        self.swap_db(build_file)
+
+    def swap_db(self, filename):
+        """Replace the current database file with a new one."""
+        # all connections have to be closed before the file can be replaced
+        # on windows, and a stale wal file must not be applied to the new db
+        with self.pool:
+            self.swapping = True
+        try:
+            self.close()
+            for suffix in ("-wal", "-shm"):
+                if os.path.isfile(self.assets_db + suffix):
+                    os.remove(self.assets_db + suffix)
+            os.replace(filename, self.assets_db)
+            self.ready = True
+        finally:
+            with self.pool:
+                self.swapping = False
+                self.pool.notify_all()
+        # anything cached came from the old database
+        lookup_cache.clear()
+
+    @profiling.timed("index.layer")
+    def index_layer(self, db, name, path, priority, progress):
+        """
+        (Re)index everything in a single asset layer using a db connection.
+        Overrides still need to be resolved afterwards.
+        """
+        source = get_source(path)
+        # frames and images can come from any layer below this one too
+        below = self.get_layers()[:priority]
+        frames = FramesCache([source] + [get_source(x[1]) for x in reversed(below)])
+        discovery = discover_assets(source)
+        progress.discovered += len(discovery.items) + len(discovery.blueprints)
+        progress.report(True)
+        for table in layer_tables:
+            db.execute("delete from " + table + " where layer = ?", (name,))
+        db.execute("insert or replace into layers values (?, ?, ?, ?)",
+                   (name, path, priority, discovery.signature()))
+        Items().add_all_items(db, source, name, discovery.items, progress, frames)
+        Blueprints().add_all_blueprints(db, source, name, discovery.blueprints, progress)
+
+    def update_layers(self, check_changes=False, progress=None):
+        """
+        Bring the database in line with the configured asset layers without a
+        full rebuild. New layers get indexed, removed ones are dropped and
+        reordered ones get their priority updated. If check_changes is set
+        layers are also reindexed when their files have changed on disk.
+
+        Returns a LayerChanges of the layer names that were reindexed,
+        dropped and reordered.
+        """
+        if progress is None:
+            progress = IndexProgress()
+        # archives may have been patched since they were opened
+        refresh_sources()
 
-        self.db = sqlite3.connect(self.assets_db)
+        layers = self.get_layers()
+        indexed = {}
+        for row in self.query("select name, path, priority, signature from layers"):
+            indexed[row[0]] = row[1:]
+
+        changes = []
+        reindex = []
+        reordered = []
+        for priority in range(len(layers)):
+            name, path = layers[priority]
+            if name not in indexed or indexed[name][0] != path:
+                reindex.append((name, path, priority))
+            elif check_changes and indexed[name][2] != discover_assets(get_source(path)).signature():
+                reindex.append((name, path, priority))
+            elif indexed[name][1] != priority:
+                changes.append(("update layers set priority = ? where name = ?", (priority, name)))
+                reordered.append(name)
+
+        names = [x[0] for x in layers]
+        dropped = [x for x in indexed.keys() if x not in names]
+        for name in dropped:
+            for table in layer_tables:
+                changes.append(("delete from " + table + " where layer = ?", (name,)))
+            changes.append(("delete from layers where name = ?", (name,)))
+
+        result = LayerChanges([x[0] for x in reindex], dropped, reordered)
+        if not result.changed():
+            return result
+
+        db = sqlite3.connect(self.assets_db, isolation_level=None)
+        try:
+            db.execute("begin immediate")
+            for q, args in changes:
+                db.execute(q, args)
+            for name, path, priority in reindex:
+                self.index_layer(db, name, path, priority, progress)
+            for q in resolve_overrides:
+                db.execute(q)
+            db.execute("commit")
+            progress.report(True)
+        except BaseException:
+            if db.in_transaction:
+                db.execute("rollback")
+            raise
+        finally:
+            db.close()
+
+        lookup_cache.clear()
+        return result
+
+    def get_version(self):
+        """Return the schema version of the database file on disk."""
+        db = sqlite3.connect(self.assets_db)
+        try:
+            return db.execute("pragma user_version").fetchone()[0]
+        finally:
+            db.close()
+
+    def rebuild_db(self, progress=None):
+        """Throw away the current database and index everything again."""
+        self.init_db(progress)
+
+    def verify(self):
+        """
+        Check the database against the asset layers it should be indexing.
+        Returns a list of problems, empty if everything is fine.
+        """
+        if not os.path.isfile(self.assets_db):
+            return ["Database does not exist"]
+        version = self.get_version()
+        if version != db_version:
+            return ["Database version is %d, expected %d" % (version, db_version)]
 
-    def init_db(self):
-        """Create and populate a brand new assets database."""
-        tables = ("create table items (name text, filename text, folder text, icon text, category text)",
-                  "create table blueprints (name text, filename text, folder text, category text)")
         db = sqlite3.connect(self.assets_db)
-        c = db.cursor()
+        try:
+            problems = [r[0] for r in db.execute("pragma integrity_check") if r[0] != "ok"]
+            indexed = {}
+            for row in db.execute("select name, path, priority, signature from layers"):
+                indexed[row[0]] = row[1:]
+        finally:
+            db.close()
+
+        layers = self.get_layers()
+        for priority in range(len(layers)):
+            name, path = layers[priority]
+            if name not in indexed:
+                problems.append("Layer %s (%s) is not indexed" % (name, path))
+            elif indexed[name][0] != path:
+                problems.append("Layer %s is indexed from %s, not %s" % (name, indexed[name][0], path))
+            elif indexed[name][1] != priority:
+                problems.append("Layer %s has the wrong priority" % name)
+            elif indexed[name][2] != discover_assets(get_source(path)).signature():
+                problems.append("Layer %s has changed since it was indexed" % name)
 
-        for q in tables:
-            c.execute(q)
-        db.commit()
+        names = [x[0] for x in layers]
+        for name in indexed.keys():
+            if name not in names:
+                problems.append("Layer %s is indexed but no longer configured" % name)
+
+        return problems
+
+    def export_snapshot(self, filename):
+        """
+        Write a copy of the database that can be imported on another machine
+        indexing the same asset layers, see import_snapshot().
+        """
+        if self.needs_build():
+            raise SnapshotError("Database needs to be built first")
+        # a snapshot of an out of date database would pass for a good one
+        problems = self.verify()
+        if len(problems) > 0:
+            raise SnapshotError("Database needs to be updated first: " + "; ".join(problems))
+
+        # fingerprints are recorded so the import can check it's being used
+        # with the same assets. they describe the layers the database holds
+        fingerprints = []
+        for name, path in self.query("select name, path from layers order by priority"):
+            fingerprints.append((name, discover_assets(get_source(path)).fingerprint()))
+
+        if os.path.isfile(filename):
+            os.remove(filename)
+        src = self.connect_reader()
+        dest = sqlite3.connect(filename, isolation_level=None)
+        try:
+            src.backup(dest)
+            # snapshots are a single self contained file
+            dest.execute("pragma journal_mode=delete")
+            dest.execute("create table snapshot (key text primary key, value text)")
+            meta = (("format", str(snapshot_format)),
+                    ("db_version", str(db_version)),
+                    ("created", time.strftime("%Y-%m-%d %H:%M:%S")),
+                    ("layers", json.dumps(fingerprints)))
+            dest.executemany("insert into snapshot values (?, ?)", meta)
+            dest.execute("vacuum")
+        finally:
+            src.close()
+            dest.close()
+
+    def import_snapshot(self, filename, force=False):
+        """
+        Replace the database with an exported snapshot. The snapshot's layers
+        must match the configured ones (same names and files) unless force is
+        set. Layer paths are updated to the local ones.
+        """
+        if not os.path.isfile(filename):
+            raise SnapshotError("Snapshot %s does not exist" % filename)
+
+        build_file = self.assets_db + ".build"
+        if os.path.isfile(build_file):
+            os.remove(build_file)
+
+        src = sqlite3.connect(filename)
+        db = sqlite3.connect(build_file, isolation_level=None)
+        try:
+            try:
+                meta = dict(src.execute("select key, value from snapshot"))
+            except sqlite3.DatabaseError:
+                raise SnapshotError("%s is not a starcheat snapshot" % filename)
+            if meta.get("format") != str(snapshot_format) or meta.get("db_version") != str(db_version):
+                raise SnapshotError("Snapshot is from a different version of starcheat")
+
+            # rows are tagged by layer name so those always have to match
+            layers = self.get_layers()
+            snapshot_layers = [tuple(x) for x in json.loads(meta["layers"])]
+            if [x[0] for x in snapshot_layers] != [x[0] for x in layers]:
+                raise SnapshotError("Snapshot layers (%s) don't match the configured layers (%s)" %
+                                    (", ".join([x[0] for x in snapshot_layers]),
+                                     ", ".join([x[0] for x in layers])))
+            local = [discover_assets(get_source(path)) for name, path in layers]
+            matches = [snapshot_layers[i][1] == local[i].fingerprint() for i in range(len(layers))]
+            if not force and not all(matches):
+                raise SnapshotError("Snapshot was made from different assets")
+
+            src.backup(db)
+            db.execute("begin")
+            db.execute("drop table snapshot")
+            db.execute("delete from layers")
+            for priority in range(len(layers)):
+                # layers forced in from different assets get a signature that
+                # never matches, so verify flags them and update reindexes them
+                signature = local[priority].signature() if matches[priority] else "forced"
+                db.execute("insert into layers values (?, ?, ?, ?)",
+                           (layers[priority][0], layers[priority][1], priority, signature))
+            db.execute("commit")
+            db.execute("pragma journal_mode=wal")
+        except BaseException:
+            src.close()
+            db.close()
+            os.remove(build_file)
+            raise
+        src.close()
         db.close()
 
-        Items().add_all_items()
-        Blueprints().add_all_blueprints()
+        self.swap_db(build_file)
+
+shared_db = None
+shared_db_lock = threading.Lock()
+
+def get_assets_db(refresh=True):
+    """
+    Return the process wide AssetsDb, creating it on first use. Unless refresh
+    is False a new instance gets built or updated straight away, the GUI turns
+    that off and does it in the background instead.
+    """
+    global shared_db
+    with shared_db_lock:
+        if shared_db is None:
+            shared_db = AssetsDb()
+            if refresh:
+                shared_db.refresh()
+        return shared_db
+
+def recipe_items(recipe, key):
+    """
+    Return (item name, count) for the input or output of a parsed recipe.
+    Either can be a single item or a list, older assets call the name "item"
+    and newer ones call it "name".
+    """
+    found = []
+    items = recipe.get(key, [])
+    if type(items) is dict:
+        items = [items]
+
+    for item in items:
+        try:
+            name = item.get("item", item.get("name"))
+            count = item.get("count", 1)
+        except AttributeError:
+            continue
+        if name is not None:
+            found.append((name, count))
+    return found
+
+# rarities in the order the game ranks them
+rarities = ("common", "uncommon", "rare", "legendary", "essential")
+
+# order by clauses for sorting item lists, unknown values go last
+item_sorts = {
+    # only means something when searching, see filter_items
+    "best match": "name collate nocase",
+    "name": "name collate nocase",
+    "rarity": "case rarity %s else %d end, name collate nocase" % (
+        " ".join("when '%s' then %d" % (r, i) for i, r in enumerate(rarities)), len(rarities)),
+    "price": "price is null, price desc, name collate nocase",
+    "max stack": "max_stack is null, max_stack desc, name collate nocase"
+}
+
+# color codes in descriptions, like ^orange;
+color_code_re = re.compile(r"\^[^;^]*;")
+
+def item_metadata(info):
+    """
+    Return (description, rarity, max stack, price, race) from a parsed item
+    file, with None for anything missing or the wrong type.
+    """
+    def typed(key, kind):
+        value = info.get(key)
+        if kind is int and type(value) in (int, float):
+            return int(value)
+        if kind is str and type(value) is str:
+            return value
+        return None
+
+    description = typed("shortdescription", str)
+    if description is not None:
+        description = color_code_re.sub("", description)
+    rarity = typed("rarity", str)
+    if rarity is not None:
+        rarity = rarity.lower()
+
+    return (description, rarity, typed("maxStack", int), typed("price", int),
+            typed("race", str))
 
-    def rebuild_db(self):
-        pass
+def item_tags(info):
+    """Return the unique item and colony tags of a parsed item file."""
+    tags = set()
+    for key in ("itemTags", "colonyTags"):
+        value = info.get(key, [])
+        if type(value) is list:
+            tags.update(t for t in value if type(t) is str)
+    return tags
+
+word_re = re.compile("[a-z0-9]+")
+
+def trigrams(text):
+    """
+    Return the set of trigrams in some text for fuzzy searching. Like
+    postgres' pg_trgm each lowercased word is padded with two spaces in front
+    and one behind, so matching word starts count for more.
+    """
+    found = set()
+    for word in word_re.findall(text.lower()):
+        word = "  " + word + " "
+        found.update(word[i:i+3] for i in range(len(word) - 2))
+    return found
+
+# fraction of a search's trigrams an item needs to count as a match
+search_threshold = 0.5
+
+# the active blueprint rows matching a recipe table row (r)
+active_recipe_join = "join blueprints b on b.name = r.blueprint and b.layer = r.layer and b.active = 1"
 
 class Blueprints():
-    def __init__(self):
+    def __init__(self, db=None):
         """Everything dealing with indexing and parsing blueprint asset files."""
-        self.blueprints_folder = os.path.join(config.Config().read()["assets_folder"], "recipes")
-        self.db = AssetsDb().db
-
-    def file_index(self):
-        """Return a list of all valid blueprints files."""
-        index = []
-        for root, dirs, files in os.walk(self.blueprints_folder):
-            for f in files:
-                if re.match(".*\.recipe", f) != None:
-                    index.append((f, root))
-        print("Found " + str(len(index)) + " blueprint files")
-        return index
-
-    def add_all_blueprints(self):
-        """Parse and insert every indexable blueprint asset."""
-        index = self.file_index()
+        self._db = db
+
+    @property
+    def db(self):
+        # only touch the database when we actually miss the lookup cache
+        if self._db is None:
+            self._db = get_assets_db()
+        return self._db
+
+    @profiling.timed("index.blueprints")
+    def add_all_blueprints(self, db, source, layer, index, progress):
+        """
+        Parse and insert blueprints from an asset layer using a db connection.
+        index is the list of discovered blueprint files.
+        """
         blueprints = []
-        print("Indexing", end="")
+        inputs = []
+        outputs = []
         for f in index:
-            full_path = os.path.join(f[1], f[0])
-
             try:
-                info = parse_json(full_path)
+                info = source.read_json(f[0])
             except ValueError:
+                progress.file_done(failed=True)
                 continue
 
-            name = f[0].partition(".")[0]
-            filename = f[0]
-            folder = f[1]
+            folder, filename = posixpath.split(f[0])
+            name = filename.partition(".")[0]
 
             try:
                 category = info["groups"][1]
             except (KeyError, IndexError):
                 category = "other"
 
-            blueprints.append((name, filename, folder, category))
-            print(".", end="")
-        c = self.db.cursor()
-        q = "insert into blueprints values (?, ?, ?, ?)"
-        c.executemany(q, blueprints)
-        self.db.commit()
-        print("Done!")
+            blueprints.append((name, filename, folder, category, layer))
+            for item in recipe_items(info, "input"):
+                inputs.append((name, item[0], item[1], layer))
+            for item in recipe_items(info, "output"):
+                outputs.append((name, item[0], item[1], layer))
+            progress.file_done()
+        db.executemany("insert into blueprints values (?, ?, ?, ?, ?, 1)", blueprints)
+        db.executemany("insert into recipe_inputs values (?, ?, ?, ?)", inputs)
+        db.executemany("insert into recipe_outputs values (?, ?, ?, ?)", outputs)
+        progress.rows += len(blueprints) + len(inputs) + len(outputs)
 
     def get_all_blueprints(self):
         """Return a list of every indexed blueprints."""
-        c = self.db.cursor()
-        c.execute("select * from blueprints order by name collate nocase")
-        return c.fetchall()
+        return self.db.query("select * from blueprints where active = 1 order by name collate nocase")
+
+    def get_blueprint_names(self, offset=0, limit=-1):
+        """Return one page of the names of every blueprint, in list order."""
+        q = """select name from blueprints where active = 1 order by name collate nocase
+               limit ? offset ?"""
+        return [x[0] for x in self.db.query(q, (limit, offset))]
+
+    @cached_lookup
+    def get_blueprint_count(self):
+        """Return how many blueprints are indexed."""
+        return self.db.query("select count(*) from blueprints where active = 1", one=True)[0]
 
+    def find_blueprints(self, names):
+        """Return the names out of a collection of blueprint names that are indexed."""
+        names = list(names)
+        found = []
+        # stay well under sqlite's limit on query parameters
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            q = "select name from blueprints where active = 1 and name in (%s)"
+            q = q % ", ".join("?" * len(chunk))
+            found += [x[0] for x in self.db.query(q, chunk)]
+        return found
+
+    @cached_lookup
     def get_categories(self):
         """Return a list of all unique blueprint categories."""
-        c = self.db.cursor()
-        c.execute("select distinct category from blueprints order by category")
-        return c.fetchall()
+        return self.db.query("select distinct category from blueprints where active = 1 order by category")
+
+    @cached_lookup
+    def get_crafted_from(self, item):
+        """Return (blueprint, input item, count) for every recipe that makes an item."""
+        q = """select b.name, i.item, i.count from recipe_outputs r """ + active_recipe_join + """
+               join recipe_inputs i on i.blueprint = r.blueprint and i.layer = r.layer
+               where r.item = ? order by b.name, i.item"""
+        return self.db.query(q, (item,))
+
+    @cached_lookup
+    def get_used_in(self, item):
+        """Return the names of every blueprint that takes an item as input."""
+        q = """select distinct b.name from recipe_inputs r """ + active_recipe_join + """
+               where r.item = ? order by b.name"""
+        return [x[0] for x in self.db.query(q, (item,))]
+
+    @cached_lookup
+    def get_outputs(self, blueprint):
+        """Return the names of the items a blueprint makes."""
+        q = "select r.item from recipe_outputs r " + active_recipe_join + " where r.blueprint = ?"
+        return [x[0] for x in self.db.query(q, (blueprint,))]
 
-    def filter_blueprints(self, category, name):
-        """Filter blueprints based on category and name."""
+    def get_required_blueprints(self, blueprints):
+        """
+        Return the names of every blueprint needed to craft what a list of
+        blueprints makes from scratch, following the recipe inputs all the
+        way down. Done in a single query.
+        """
+        if len(blueprints) == 0:
+            return []
+
+        targets = ", ".join(["(?)"] * len(blueprints))
+        q = """with recursive targets(blueprint) as (values """ + targets + """),
+               needed(item) as (
+                   select r.item from targets t
+                   join recipe_outputs r on r.blueprint = t.blueprint """ + active_recipe_join + """
+                   union
+                   select i.item from needed n
+                   join recipe_outputs r on r.item = n.item """ + active_recipe_join + """
+                   join recipe_inputs i on i.blueprint = r.blueprint and i.layer = r.layer
+               )
+               select distinct b.name from needed n
+               join recipe_outputs r on r.item = n.item """ + active_recipe_join + """
+               order by b.name"""
+        return [x[0] for x in self.db.query(q, tuple(blueprints))]
+
+    def filter_blueprints(self, category, name, cancel=None, names_only=False):
+        """
+        Filter blueprints based on category and name. See AssetsDb.query for
+        cancel. names_only returns just a list of names.
+        """
         if category == "<all>":
             category = "%"
         name = "%" + name + "%"
-        c = self.db.cursor()
-        q = "select * from blueprints where category like ? and name like ? order by name collate nocase"
-        c.execute(q, (category, name))
-        result = c.fetchall()
-        return result
+        q = """select %s from blueprints where active = 1 and category like ? and name like ?
+               order by name collate nocase"""
+        if names_only:
+            return [x[0] for x in self.db.query(q % "name", (category, name), cancel=cancel)]
+        return self.db.query(q % "*", (category, name), cancel=cancel)
 
 class Items():
-    def __init__(self):
+    def __init__(self, db=None):
         """Everything dealing with indexing and parsing item asset files."""
-        self.assets_folder = config.Config().read()["assets_folder"]
-        self.items_folder = os.path.join(self.assets_folder, "items")
-        self.objects_folder = os.path.join(self.assets_folder, "objects")
-        self.tech_folder = os.path.join(self.assets_folder, "tech")
-        self.ignore_items = ".*\.(png|config|frames|coinitem)"
-        self.mod_assets_folder = config.Config().read()["mod_assets_folder"]
-        self.mod_items_folder = os.path.join(self.mod_assets_folder, "items")
-        self.db = AssetsDb().db
-
-    def file_index(self):
-        """Return a list of every indexable Starbound item asset."""
-        index = []
-        # regular items
-        for root, dirs, files in os.walk(self.items_folder):
-            for f in files:
-                # don't care about png and config and all that
-                if re.match(self.ignore_items, f) == None:
-                    index.append((f, root))
-        #mod items
-        for root, dirs, files in os.walk(self.items_folder):
-            for f in files:
-                # don't care about png and config and all that
-                if re.match(self.ignore_items, f) == None:
-                    index.append((f, root))
-        # objects
-        for root, dirs, files in os.walk(self.objects_folder):
-            for f in files:
-                if re.match(".*\.object$", f) != None:
-                    index.append((f, root))
-        # techs
-        for root, dirs, files in os.walk(self.tech_folder):
-            for f in files:
-                if re.match(".*\.techitem$", f) != None:
-                    index.append((f, root))
-        print("Found " + str(len(index)) + " item files")
-        return index
-
-    def add_all_items(self):
-        """Insert metadata for every possible item into the database."""
-        index = self.file_index()
+        self._db = db
+
+    @property
+    def db(self):
+        # only touch the database when we actually miss the lookup cache
+        if self._db is None:
+            self._db = get_assets_db()
+        return self._db
+
+    @profiling.timed("index.items")
+    def add_all_items(self, db, source, layer, index, progress, frames=None):
+        """
+        Insert metadata for items from an asset layer using a db connection.
+        index is the list of discovered item files, frames an optional
+        FramesCache that also sees the layers below this one.
+        """
         items = []
+        tags = []
+        search = []
+        if frames is None:
+            frames = FramesCache([source])
+        no_rect = (None, None, None, None)
+
+        def add_item(item_name, icon, icon_rect):
+            found = trigrams(item_name + " " + (meta[0] or ""))
+            items.append(((item_name, filename, path, icon, category, layer) +
+                          (icon_rect or no_rect) + image + meta + (len(found),), found))
 
-        print("Indexing", end="")
         for f in index:
             # load the asset's json file
-            full_path = os.path.join(f[1], f[0])
             try:
-                info = parse_json(full_path)
+                info = source.read_json(f[0])
             except ValueError:
+                progress.file_done(failed=True)
                 continue
 
             # figure out the item's name. it can be a few things
@@ -199,124 +1293,203 @@ class Items():
                 try:
                     name = info["name"]
                 except KeyError:
-                    name = info["objectName"]
+                    try:
+                        name = info["objectName"]
+                    except KeyError:
+                        # not actually an item
+                        progress.file_done(failed=True)
+                        continue
 
-            filename = f[0]
-            path = f[1]
+            path, filename = posixpath.split(f[0])
             # just use the file extension as category
-            category = f[0].partition(".")[2]
+            category = filename.partition(".")[2]
+
+            # TODO: support for generated item images
+            if type(info.get("image")) is str:
+                image, image_rect = frames.resolve(path, info["image"])
+            else:
+                image, image_rect = None, None
+            image = (image,) + (image_rect or no_rect)
+            meta = item_metadata(info)
 
             # get full path to an inventory icon
             try:
-                asset_icon = info["inventoryIcon"]
-                if re.match(".*\.techitem$", f[0]) != None:
-                    icon = self.assets_folder + asset_icon
+                icon, icon_rect = frames.resolve(path, info["inventoryIcon"])
+                if icon is None:
+                    icon = self.missing_icon()
+                if filename.endswith(".techitem"):
                     # index dynamic tech chip items too
                     # TODO: do we keep the non-chip items in or not? i don't
                     #       think you're meant to have them outside tech slots
-                    chip_name = name + "-chip"
-                    items.append((chip_name, filename, path, icon, category))
-                else:
-                    icon = os.path.join(f[1], info["inventoryIcon"])
-            except KeyError:
-                if re.search("(sword|shield)", category) != None:
+                    add_item(name + "-chip", icon, icon_rect)
+            except (KeyError, AttributeError):
+                icon_rect = None
+                if "sword" in category or "shield" in category:
                     cat = category.replace("generated", "")
-                    icon = os.path.join(self.assets_folder, "interface", "inventory", cat + ".png")
+                    icon = "/interface/inventory/" + cat + ".png"
                 else:
                     icon = self.missing_icon()
 
-            items.append((name, filename, path, icon, category))
-            print(".", end="")
+            add_item(name, icon, icon_rect)
+            tags.extend((name, tag, layer) for tag in item_tags(info))
+            progress.file_done()
 
-        c = self.db.cursor()
-        q = "insert into items values (?, ?, ?, ?, ?)"
-        c.executemany(q, items)
-        self.db.commit()
-        print("Done!")
+        q = """insert into items (name, filename, folder, icon, category, layer, active,
+                                  icon_x, icon_y, icon_w, icon_h,
+                                  image, image_x, image_y, image_w, image_h,
+                                  description, rarity, max_stack, price, race, trigrams)
+               values (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        # one at a time to get the new ids for the search index
+        for row, found in items:
+            item_id = db.execute(q, row).lastrowid
+            search.extend((t, item_id, layer) for t in found)
+        db.executemany("insert into item_tags values (?, ?, ?)", tags)
+        db.executemany("insert into item_trigrams values (?, ?, ?)", search)
+        progress.rows += len(items) + len(tags) + len(search)
 
     def get_all_items(self):
         """Return a list of every indexed item."""
-        c = self.db.cursor()
-        c.execute("select * from items order by name collate nocase")
-        return c.fetchall()
+        return self.db.query("select * from items where active = 1 order by name collate nocase")
+
+    def get_item_names(self, offset=0, limit=-1):
+        """Return one page of the names of every item, in list order."""
+        q = """select name from items where active = 1 order by name collate nocase
+               limit ? offset ?"""
+        return [x[0] for x in self.db.query(q, (limit, offset))]
+
+    @cached_lookup
+    def get_layers(self):
+        """Return (name, path) of every indexed asset layer, highest priority first."""
+        return self.db.query("select name, path from layers order by priority desc")
+
+    def layer_source(self, layer):
+        """Return the asset source for an indexed layer."""
+        return get_source(dict(self.get_layers())[layer])
+
+    @cached_lookup
+    def find_asset(self, path):
+        """Return the highest priority layer containing an asset path, or None."""
+        for layer in self.get_layers():
+            if get_source(layer[1]).exists(path):
+                return layer[0]
+        return None
 
+    @cached_lookup
     def get_item(self, name):
         """
         Find the first hit in the DB for a given item name, return the
         parsed asset file and location.
         """
-        c = self.db.cursor()
-        c.execute("select folder, filename from items where name = ?", (name,))
-        meta = c.fetchone()
-        item = parse_json(os.path.join(meta[0], meta[1]))
+        q = "select folder, filename, layer from items where name = ? and active = 1"
+        meta = self.db.query(q, (name,), one=True)
+        item = self.layer_source(meta[2]).read_json(posixpath.join(meta[0], meta[1]))
         return item, meta[0], meta[1]
 
+    @cached_lookup
     def get_categories(self):
         """Return a list of all unique indexed item categories."""
-        c = self.db.cursor()
-        c.execute("select distinct category from items order by category")
-        return c.fetchall()
+        return self.db.query("select distinct category from items where active = 1 order by category")
 
-    def get_item_icon(self, name):
-        """Return the path and spritesheet offset of a given item name."""
-        c = self.db.cursor()
-        c.execute("select icon from items where name = ?", (name,))
-        try:
-            icon_file = c.fetchone()[0]
-            # TODO: just double check the split usage, may be deprecated
-            if system() != 'Windows':
-                icon = icon_file.split(':')
-            else:
-                icon = icon_file.rsplit(':', icon_file.count(':') - 1)
-            if len(icon) < 2:
-                icon = icon[0], 0
-        except TypeError:
+    def image_rect(self, row):
+        """
+        Turn a (path, x, y, w, h) row into an image path and rect, None if
+        the asset doesn't exist. A None rect means use the whole image.
+        """
+        if row is None or row[0] is None or self.find_asset(row[0]) is None:
             return None
+        if row[1] is None:
+            return row[0], None
+        return row[0], tuple(row[1:])
 
-        try:
-            open(icon[0])
-        except FileNotFoundError:
-            return None
+    @cached_lookup
+    def get_item_icon(self, name):
+        """Return the asset path and spritesheet rect of a given item's icon."""
+        q = "select icon, icon_x, icon_y, icon_w, icon_h from items where name = ? and active = 1"
+        return self.image_rect(self.db.query(q, (name,), one=True))
 
-        if icon[1] == "chest":
-            return icon[0], 16
-        elif icon[1] == "pants":
-            return icon[0], 32
+    @cached_lookup
+    def get_item_image(self, name):
+        """Return the asset path and spritesheet rect of a given item's image."""
+        q = "select image, image_x, image_y, image_w, image_h from items where name = ? and active = 1"
+        return self.image_rect(self.db.query(q, (name,), one=True))
 
-        return icon[0], 0
+    def read_asset(self, path):
+        """
+        Return the raw contents of an asset file (like an icon image) from the
+        highest priority layer that has it.
+        """
+        layer = self.find_asset(path)
+        if layer is None:
+            raise FileNotFoundError(path)
+        return self.layer_source(layer).read(path)
 
-    def get_item_image(self, name):
-        """Return a vaild item image path for given item name."""
-        item = self.get_item(name)
-
-        # TODO: support for frame selectors
-        # TODO: support for generated item images
-        if "image" in item[0]:
-            if re.search(":", item[0]["image"]):
-                image = item[0]["image"].partition(":")[0]
-            else:
-                image = item[0]["image"]
+    def missing_icon(self):
+        """Return the asset path to the default inventory placeholder icon."""
+        return "/interface/inventory/x.png"
 
-            try:
-                path = os.path.join(item[1], image)
-                open(path)
-                return path
-            except FileNotFoundError:
-                return None
+    @cached_lookup
+    def get_item_meta(self, name):
+        """Return (description, rarity, max stack, price, race) of a given item name."""
+        q = """select description, rarity, max_stack, price, race from items
+               where name = ? and active = 1"""
+        return self.db.query(q, (name,), one=True)
+
+    @cached_lookup
+    def get_item_tags(self, name):
+        """Return a sorted list of the tags of a given item name."""
+        q = """select distinct t.tag from item_tags t
+               join items i on i.name = t.item and i.layer = t.layer and i.active = 1
+               where t.item = ? order by t.tag"""
+        return [r[0] for r in self.db.query(q, (name,))]
+
+    def filter_items(self, category, name, rarity="<all>", sort="best match", tag=None,
+                     cancel=None, names_only=False, offset=0, limit=-1):
+        """
+        Search for indexed items based on category and a fuzzy match on name
+        or description. Optionally filter on rarity and tag, sort is one of
+        item_sorts. See AssetsDb.query for cancel. names_only returns just a
+        list of names. offset and limit return one page of the results.
+        """
+        columns = "items.name" if names_only else "items.*"
+        search = trigrams(name)
+        like = "%" + name + "%"
+        order = item_sorts[sort]
+        order_args = []
+
+        if len("".join(word_re.findall(name.lower()))) < 3:
+            # too short for trigrams to mean much, plain substring match
+            q = "select " + columns + " from items where (name like ? or description like ?)"
+            args = [like, like]
         else:
-            return None
+            # count matching trigrams per item. substring matches always get
+            # in, anything else needs enough trigrams to match
+            q = """select %s from (select item, count(*) as hits from item_trigrams
+                                        where trigram in (%s) group by item) m
+                   join items on items.id = m.item
+                   where (m.hits >= ? or items.name like ? or items.description like ?)"""
+            q = q % (columns, ", ".join("?" * len(search)))
+            min_hits = max(1, math.ceil(len(search) * search_threshold))
+            args = list(search) + [min_hits, like, like]
 
-    def missing_icon(self):
-        """Return the path to the default inventory placeholder icon."""
-        return os.path.join(self.assets_folder, "interface", "inventory", "x.png")
+            if sort == "best match":
+                # substring matches first, then the most matching trigrams,
+                # then the closest overall match
+                order = """(items.name like ? or items.description like ?) desc, m.hits desc,
+                           m.hits * 1.0 / (items.trigrams + ? - m.hits) desc, """ + order
+                order_args = [like, like, len(search)]
 
-    def filter_items(self, category, name):
-        """Search for indexed items based on name and category."""
-        if category == "<all>":
-            category = "%"
-        name = "%" + name + "%"
-        c = self.db.cursor()
-        c.execute("select * from items where category like ? and name like ? order by name collate nocase",
-                  (category, name))
-        result = c.fetchall()
+        q += " and active = 1 and category like ?"
+        args.append("%" if category == "<all>" else category)
+
+        if rarity != "<all>":
+            q += " and rarity = ?"
+            args.append(rarity)
+        if tag is not None:
+            q += " and exists (select 1 from item_tags t where t.item = items.name and t.layer = items.layer and t.tag = ?)"
+            args.append(tag)
+
+        q += " order by " + order + " limit ? offset ?"
+        result = self.db.query(q, args + order_args + [limit, offset], cancel=cancel)
+        if names_only:
+            return [x[0] for x in result]
         return result
@@ -2,7 +2,7 @@
 Config file module
 """
 
-import configparser, os, platform
+import configparser, os, platform, threading
 
 if platform.system() == "Windows":
     config_folder = os.path.join(os.path.expandvars("%APPDATA%"), "starcheat")
@@ -17,45 +17,86 @@ ini_file = os.path.join(config_folder, "starcheat.ini")
 assets_folder = ""
 player_folder = ""
 # I need some GUI handling with this variable, right now it's just manual
+# it's a list of mod folders (or .pak files) separated by os.pathsep, each
+# one overrides the base assets and any mods before it
 mod_assets_folder = ""
 
+# memory the GUI can use for keeping item icons around, in MB
+icon_cache_mb = "32"
+# debug, info, warning or error. see logs.setup
+log_level = "warning"
+# no, yes or cprofile. see profiling.py
+profile = "no"
+
 backup_folder = os.path.join(config_folder, "backups")
 make_backups = "no"
 update_timestamps = "no"
 assets_db = os.path.join(config_folder, "assets.db")
 
+# the parsed ini is shared by every Config instance and only read again when
+# the file changes on disk
+cache = {"parser": None, "mtime": None}
+cache_lock = threading.RLock()
+
+def ini_mtime():
+    try:
+        return os.stat(ini_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 class Config():
     def __init__(self):
-        self.config = configparser.ConfigParser()
+        with cache_lock:
+            if cache["parser"] is None and not os.path.isfile(ini_file):
+                self.create_config()
 
-        try:
-            open(ini_file)
-        except FileNotFoundError:
-            self.create_config()
+    @property
+    def config(self):
+        """The cached ConfigParser, reloaded if the ini has changed."""
+        with cache_lock:
+            mtime = ini_mtime()
+            if cache["parser"] is None or cache["mtime"] != mtime:
+                parser = configparser.ConfigParser()
+                parser.read(ini_file)
+                cache["parser"] = parser
+                cache["mtime"] = mtime
+            return cache["parser"]
 
     def read(self, option=None):
-        self.config.read(ini_file)
         if option != None:
             return self.config["starcheat"][option]
         else:
             return self.config["starcheat"]
 
     def create_config(self):
-        self.config["starcheat"] = {
+        parser = configparser.ConfigParser()
+        parser["starcheat"] = {
             "assets_folder": assets_folder,
             "player_folder": player_folder,
             "backup_folder": backup_folder,
             "assets_db": assets_db,
             "make_backups": make_backups,
             "update_timestamps": update_timestamps,
-            "mod_assets_folder": mod_assets_folder
+            "mod_assets_folder": mod_assets_folder,
+            "icon_cache_mb": icon_cache_mb,
+            "log_level": log_level,
+            "profile": profile
         }
 
         if os.path.isdir(config_folder) == False:
             os.mkdir(config_folder)
 
-        self.config.write(open(ini_file, "w"))
+        self.save(parser)
 
     def write(self, config):
-        self.config["starcheat"] = config
-        self.config.write(open(ini_file, "w"))
+        parser = self.config
+        parser["starcheat"] = config
+        self.save(parser)
+
+    def save(self, parser):
+        """Write a ConfigParser to the ini and make it the cached one."""
+        with cache_lock:
+            with open(ini_file, "w") as f:
+                parser.write(f)
+            cache["parser"] = parser
+            cache["mtime"] = ini_mtime()
@@ -3,22 +3,40 @@ GUI module for starcheat
 """
 
 import sys, os
-from PyQt5 import QtWidgets
-from PyQt5.QtWidgets import QApplication, QDialog, QMainWindow
-from PyQt5.QtWidgets import QFileDialog, QTableWidgetItem, QMessageBox
+from PyQt5.QtWidgets import QApplication, QMainWindow
 
 from config import Config
-import save_file, assets
-import qt_mainwindow, qt_options, qt_openplayer
-# TODO: it doesn't feel right doing this, just import the required specific classes
-from gui_common import *
-from gui_utils import *
-from gui_itemedit import *
-from gui_blueprints import *
-
-# TODO: get rid of this, import Config direct and just use the new read func
-# (same for any other files using config)
-conf = Config().read()
+import save_file, assets, gui_icons, logs
+import qt_mainwindow
+from gui_common import ItemWidget, BagModel
+from gui_utils import OptionsDialog, IndexDialog, CharacterSelectDialog
+# the item edit and blueprint dialogs (and everything they pull in) are only
+# imported the first time they're opened
+
+# how many columns each bag table has
+bag_columns = {
+    "wieldable": 2,
+    "head": 2,
+    "chest": 2,
+    "legs": 2,
+    "back": 2,
+    "main_bag": 10,
+    "action_bar": 10,
+    "tile_bag": 10
+}
+equip_bags = "head", "chest", "legs", "back"
+
+log = logs.get_logger("gui")
+
+# reloading only touches widgets whose value is different, so the cursor and
+# undo history of anything that didn't change on disk is left alone
+def set_text(widget, text):
+    if widget.text() != text:
+        widget.setText(text)
+
+def set_plain_text(widget, text):
+    if widget.toPlainText() != text:
+        widget.setPlainText(text)
 
 class MainWindow():
     def __init__(self):
@@ -34,6 +52,17 @@ class MainWindow():
         if config["player_folder"] == "" or config["assets_folder"] == "":
             self.new_setup_dialog()
 
+        # build or update the assets db in the background, everything else
+        # works fine while it's going
+        self.player = None
+        self.index_dialog = None
+        # created here so a lookup can never end up indexing on the gui thread
+        assets.get_assets_db(refresh=False)
+        self.app.aboutToQuit.connect(self.stop_indexing)
+        self.app.aboutToQuit.connect(gui_icons.stop_loading)
+        self.app.aboutToQuit.connect(gui_icons.save_atlases)
+        self.new_index_dialog()
+
         self.filename = None
         self.items = assets.Items()
 
@@ -49,6 +78,12 @@ class MainWindow():
         for race in save_file.race_types:
             self.ui.race.addItem(race)
 
+        # bag tables are views of models over the player's bags
+        self.bags = {}
+        for b in bag_columns.keys():
+            self.bags[b] = BagModel(bag_columns[b], parent=self.window)
+            getattr(self.ui, b).setModel(self.bags[b])
+
         # connect action menu
         self.ui.actionSave.triggered.connect(self.save)
         self.ui.actionReload.triggered.connect(self.reload)
@@ -58,7 +93,6 @@ class MainWindow():
 
         # launch open file dialog
         # we want this after the races are populated but before the slider setup
-        self.player = None
         self.open_file()
         # we *need* at least an initial save file
         if self.player == None:
@@ -72,12 +106,9 @@ class MainWindow():
             getattr(self.ui, "max_" + s).valueChanged.connect(update)
 
         # set up bag tables
-        bags = "wieldable", "head", "chest", "legs", "back", "main_bag", "action_bar", "tile_bag"
-        for b in bags:
+        for b in bag_columns.keys():
             item_edit = getattr(self, "new_" + b + "_item_edit")
-            getattr(self.ui, b).cellDoubleClicked.connect(item_edit)
-            # TODO: still issues with drag drop between tables
-            getattr(self.ui, b).setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
+            getattr(self.ui, b).doubleClicked.connect(item_edit)
 
         self.ui.blueprints_button.clicked.connect(self.new_blueprint_edit)
         self.ui.name.setFocus()
@@ -86,20 +117,23 @@ class MainWindow():
         sys.exit(self.app.exec_())
 
     def update(self):
-        """Update all GUI widgets with values from PlayerSave instance."""
+        """
+        Update all GUI widgets with values from PlayerSave instance. Only the
+        ones showing something different are changed.
+        """
         # uuid / save version
-        self.ui.uuid_label.setText(self.player.get_uuid())
-        self.ui.ver_label.setText("v" + self.player.get_save_ver())
+        set_text(self.ui.uuid_label, self.player.get_uuid())
+        set_text(self.ui.ver_label, "v" + self.player.get_save_ver())
         # name
-        self.ui.name.setText(self.player.get_name())
+        set_text(self.ui.name, self.player.get_name())
         # race
         self.ui.race.setCurrentText(self.player.get_race())
         # pixels
         self.ui.pixels.setValue(self.player.get_pixels())
         # description
-        self.ui.description.setPlainText(self.player.get_description())
+        set_plain_text(self.ui.description, self.player.get_description())
         # gender
-        getattr(self.ui, self.player.get_gender()).toggle()
+        getattr(self.ui, self.player.get_gender()).setChecked(True)
 
         # stats
         stats = "health", "energy", "food", "breath"
@@ -121,20 +155,9 @@ class MainWindow():
         self.ui.warmth.setValue(cur_warmth[1])
         self.update_warmth()
 
-        # equipment
-        equip_bags = "head", "chest", "legs", "back"
-        for bag in equip_bags:
-            items = [ItemWidget(x) for x in getattr(self.player, "get_" + bag)()]
-            getattr(self.ui, bag).setItem(0, 0, items[0])
-            getattr(self.ui, bag).setItem(0, 1, items[1])
-
-        # wielded
-        self.update_bag("wieldable")
-
-        # bags
-        self.update_bag("main_bag")
-        self.update_bag("tile_bag")
-        self.update_bag("action_bar")
+        # equipment, wielded and bags. only changed slots get redrawn
+        for b in bag_columns.keys():
+            self.update_bag(b)
 
     def save(self):
         """Update internal player dict with GUI values and export to file."""
@@ -167,7 +190,6 @@ class MainWindow():
         self.player.set_max_warmth(self.ui.max_warmth.value())
 
         # equipment
-        equip_bags = "head", "chest", "legs", "back"
         for b in equip_bags:
             bag = self.get_equip(b)
             getattr(self.player, "set_" + b)(bag[0], bag[1])
@@ -178,22 +200,27 @@ class MainWindow():
             getattr(self.player, "set_" + b)(self.get_bag(b))
 
         # save and show status
+        log.debug("Saving %s", self.player.filename)
         self.player.dump()
         self.player.export_save(self.player.filename)
         self.ui.statusbar.showMessage("Saved " + self.player.filename, 3000)
 
-    def new_item_edit(self, bag):
-        """Display a new item edit dialog using the select cell in a given bag."""
-        row = bag.currentRow()
-        column = bag.currentColumn()
-        item_edit = ItemEdit(self.window, bag.currentItem())
+    def new_item_edit(self, bag, index):
+        """Display a new item edit dialog using the given cell in a given bag."""
+        model = self.bags[bag]
+        if model.slot_number(index) is None:
+            return
+        row = index.row()
+        column = index.column()
+        from gui_itemedit import ItemEdit
+        item_edit = ItemEdit(self.window, ItemWidget(model.slot(index)))
 
         def update_slot():
             new_slot = item_edit.get_item()
-            bag.setItem(row, column, new_slot)
+            model.set_slot(model.index(row, column), new_slot.get_slot())
 
         def trash_slot():
-            bag.setItem(row, column, empty_slot())
+            model.set_slot(model.index(row, column), save_file.empty_slot())
             item_edit.dialog.close()
 
         item_edit.dialog.accepted.connect(update_slot)
@@ -202,6 +229,7 @@ class MainWindow():
     def new_blueprint_edit(self):
         # TODO: why does this only work with and instance var but the other
         # ones don't...???
+        from gui_blueprints import BlueprintLib
         self.blueprint_lib = BlueprintLib(self.window, self.player.get_blueprints())
 
         def update_blueprints():
@@ -216,6 +244,8 @@ class MainWindow():
 
     def new_options_dialog(self):
         self.options_dialog = OptionsDialog(self.window)
+        rebuild = lambda: self.new_index_dialog(rebuild=True)
+        self.options_dialog.ui.rebuild_button.clicked.connect(rebuild)
 
         def write_options():
             # TODO: reload icons on asset update?
@@ -228,7 +258,42 @@ class MainWindow():
         self.setup_dialog = OptionsDialog(self.window)
         self.setup_dialog.dialog.rejected.connect(sys.exit)
         self.setup_dialog.dialog.exec()
-        self.setup_dialog.rebuild_db()
+
+    def new_index_dialog(self, rebuild=False):
+        """Build or update the assets database in the background."""
+        if self.index_dialog is not None and self.index_dialog.is_running():
+            if not rebuild:
+                return
+            self.index_dialog.stop()
+
+        self.index_dialog = IndexDialog(self.window, rebuild)
+        # a restarted rebuild replaces index_dialog before the old worker's
+        # finished arrives, so each one reports its own result
+        worker = self.index_dialog.worker
+        worker.finished.connect(lambda: self.assets_updated(worker))
+        self.index_dialog.start()
+
+    def stop_indexing(self):
+        if self.index_dialog is not None and self.index_dialog.is_running():
+            self.index_dialog.stop()
+
+    def assets_updated(self, worker):
+        """Show the result of an IndexWorker and pick up any new icons."""
+        error = worker.error
+        if error != "":
+            self.ui.statusbar.showMessage(error, 3000)
+        else:
+            self.ui.statusbar.showMessage("Assets have been indexed", 3000)
+
+        # icons might have changed
+        gui_icons.clear_pixmaps()
+        if self.player != None:
+            self.refresh_icons()
+
+    def refresh_icons(self):
+        """Reload the icon of every item in every bag."""
+        for model in self.bags.values():
+            model.refresh_icons()
 
     def reload(self):
         """Reload the currently open save file and update GUI values."""
@@ -253,78 +318,35 @@ class MainWindow():
 
     def get_bag(self, name):
         """Return the entire contents of a given non-equipment bag as raw values."""
-        row = column = 0
-        bag = getattr(self.player, "get_" + name)()
-
-        for i in range(len(bag)):
-            item = getattr(self.ui, name).item(row, column)
-            if type(item) is QTableWidgetItem or item == None:
-                item = empty_slot()
-
-            count = item.item_count
-            item_type = item.name
-            variant = item.variant
-            bag[i] = (item_type, int(count), variant)
-
-            # so far all non-equip bags are 10 cols long
-            column += 1
-            if (column % 10) == 0:
-                row += 1
-                column = 0
-
-        return bag
+        return self.bags[name].get_slots()
 
     def get_equip(self, name):
         """Return the raw values of both slots in a given equipment bag."""
-        equip = getattr(self.ui, name)
-        main_cell = equip.item(0, 0)
-        glamor_cell = equip.item(0, 1)
-
-        # when you drag itemwidgets around the cell will become empty so just
-        # pretend it had an empty slot value
-        if main_cell == None or type(main_cell) is QTableWidgetItem:
-            main = save_file.empty_slot()
-        else:
-            main = (main_cell.name, main_cell.item_count, main_cell.variant)
-
-        if glamor_cell == None or type(glamor_cell) is QTableWidgetItem:
-            glamor = save_file.empty_slot()
-        else:
-            glamor = (glamor_cell.name, glamor_cell.item_count, glamor_cell.variant)
-
+        main, glamor = self.bags[name].get_slots()
         return main, glamor
 
     def update_bag(self, bag_name):
-        """Set the entire contents of any given bag with ItemWidgets based off player data."""
-        row = column = 0
+        """Set the entire contents of any given bag from player data."""
         bag = getattr(self.player, "get_" + bag_name)()
-
-        for slot in range(len(bag)):
-            widget = ItemWidget(bag[slot])
-            getattr(self.ui, bag_name).setItem(row, column, widget)
-
-            column += 1
-            if (column % 10) == 0:
-                row += 1
-                column = 0
+        self.bags[bag_name].set_slots(bag)
 
     # these are used for connecting the item edit dialog to bag tables
-    def new_main_bag_item_edit(self):
-        self.new_item_edit(self.ui.main_bag)
-    def new_tile_bag_item_edit(self):
-        self.new_item_edit(self.ui.tile_bag)
-    def new_action_bar_item_edit(self):
-        self.new_item_edit(self.ui.action_bar)
-    def new_head_item_edit(self):
-        self.new_item_edit(self.ui.head)
-    def new_chest_item_edit(self):
-        self.new_item_edit(self.ui.chest)
-    def new_legs_item_edit(self):
-        self.new_item_edit(self.ui.legs)
-    def new_back_item_edit(self):
-        self.new_item_edit(self.ui.back)
-    def new_wieldable_item_edit(self):
-        self.new_item_edit(self.ui.wieldable)
+    def new_main_bag_item_edit(self, index):
+        self.new_item_edit("main_bag", index)
+    def new_tile_bag_item_edit(self, index):
+        self.new_item_edit("tile_bag", index)
+    def new_action_bar_item_edit(self, index):
+        self.new_item_edit("action_bar", index)
+    def new_head_item_edit(self, index):
+        self.new_item_edit("head", index)
+    def new_chest_item_edit(self, index):
+        self.new_item_edit("chest", index)
+    def new_legs_item_edit(self, index):
+        self.new_item_edit("legs", index)
+    def new_back_item_edit(self, index):
+        self.new_item_edit("back", index)
+    def new_wieldable_item_edit(self, index):
+        self.new_item_edit("wieldable", index)
 
     # these update all values in a stat group at once
     def update_energy(self):
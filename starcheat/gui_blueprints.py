@@ -5,8 +5,7 @@ Qt blueprint/recipe management dialog
 from PyQt5.QtWidgets import QDialog
 
 import assets, qt_blueprints
-
-# TODO: batch add blueprints button
+from gui_common import recipe_text, NameListModel, FilterSearch
 
 class BlueprintLib():
     def __init__(self, parent, known_blueprints):
@@ -16,17 +15,23 @@ class BlueprintLib():
         self.ui.setupUi(self.dialog)
 
         self.blueprints = assets.Blueprints()
-        self.known_blueprints = known_blueprints
 
-        # populate known list
-        self.ui.known_blueprints.clear()
-        for blueprint in self.known_blueprints:
-            self.ui.known_blueprints.addItem(blueprint)
+        # populate known list, noting which ones aren't in the assets
+        self.known_blueprints = set(known_blueprints)
+        self.missing = self.known_blueprints - set(self.blueprints.find_blueprints(self.known_blueprints))
+        self.known = NameListModel(parent=self.dialog)
+        self.ui.known_blueprints.setModel(self.known)
+        self.update_known_list()
+
+        # populate initial available list, it's only read in as it's scrolled
+        self.available = NameListModel(parent=self.dialog)
+        self.available.set_fetch(self.blueprints.get_blueprint_names)
+        self.ui.available_blueprints.setModel(self.available)
 
-        # populate initial available list
-        self.ui.available_blueprints.clear()
-        for blueprint in self.blueprints.get_all_blueprints():
-            self.ui.available_blueprints.addItem(blueprint[0])
+        # filtering happens in the background as the user types
+        self.filter_search = FilterSearch(self.search_blueprints, parent=self.dialog)
+        self.filter_search.found.connect(self.set_available_list)
+        self.dialog.finished.connect(self.filter_search.cancel)
 
         # populate category combobox
         for cat in self.blueprints.get_categories():
@@ -34,6 +39,11 @@ class BlueprintLib():
 
         self.ui.add_button.clicked.connect(self.add_blueprint)
         self.ui.remove_button.clicked.connect(self.remove_blueprint)
+        self.ui.add_required_button.clicked.connect(self.add_required_blueprints)
+        self.ui.add_filtered_button.clicked.connect(self.add_filtered_blueprints)
+        self.ui.add_category_button.clicked.connect(self.add_category_blueprints)
+        self.ui.remove_category_button.clicked.connect(self.remove_category_blueprints)
+        self.ui.available_blueprints.selectionModel().currentChanged.connect(self.update_recipe_info)
 
         self.ui.filter.textChanged.connect(self.update_available_list)
         self.ui.category.currentTextChanged.connect(self.update_available_list)
@@ -41,49 +51,110 @@ class BlueprintLib():
         self.ui.filter.setFocus()
 
     def update_available_list(self):
-        """Populate available blueprints list based on current filter details."""
+        """Search for blueprints matching the current filter details."""
         category = self.ui.category.currentText()
         name = self.ui.filter.text()
-        result = self.blueprints.filter_blueprints(category, name)
-        self.ui.available_blueprints.clear()
-        for blueprint in result:
-            self.ui.available_blueprints.addItem(blueprint[0])
-        self.ui.available_blueprints.setCurrentRow(0)
+        self.filter_search.request(category, name)
+
+    def search_blueprints(self, category, name, cancel=None):
+        # runs in the background, see FilterSearch
+        return self.blueprints.filter_blueprints(category, name, cancel, names_only=True)
+
+    def set_available_list(self, names):
+        """Populate available blueprints list with the result of a search."""
+        self.available.set_names(names)
+        self.available.fetchMore()
+        self.ui.available_blueprints.setCurrentIndex(self.available.index(0))
+
+    def selected_available(self):
+        """Return the names of the selected available blueprints."""
+        rows = self.ui.available_blueprints.selectionModel().selectedRows()
+        return [self.available.name(x) for x in rows]
+
+    def update_known_list(self, current=None):
+        """Show the known blueprints, with how they compare to the assets."""
+        names = sorted(self.known_blueprints, key=str.lower)
+        self.known.set_names(names)
+
+        text = "Known Recipes (%d of %d" % (len(self.known_blueprints) - len(self.missing),
+                                            self.blueprints.get_blueprint_count())
+        if len(self.missing) > 0:
+            text += ", %d not in assets" % len(self.missing)
+        self.ui.known_label.setText(text + ")")
+        self.ui.known_label.setToolTip("\n".join(sorted(self.missing)))
+
+        if current is not None:
+            # the list is only filled in as far as it's been scrolled
+            row = names.index(current)
+            while self.known.rowCount() <= row and self.known.canFetchMore():
+                self.known.fetchMore()
+            self.ui.known_blueprints.setCurrentIndex(self.known.index(row))
+
+    def add_blueprints(self, blueprints):
+        """Add a collection of blueprints to the known list."""
+        added = set(blueprints) - self.known_blueprints
+        if len(added) == 0:
+            return
+        self.known_blueprints |= added
+        self.missing |= added - set(self.blueprints.find_blueprints(added))
+        self.update_known_list(min(added, key=str.lower))
+
+    def remove_blueprints(self, blueprints):
+        """Remove a collection of blueprints from the known list."""
+        removed = self.known_blueprints & set(blueprints)
+        if len(removed) == 0:
+            return
+        self.known_blueprints -= removed
+        self.missing -= removed
+        self.update_known_list()
 
     def add_blueprint(self):
-        """Add currently select blueprint in available list to known list."""
-        try:
-            selected = self.ui.available_blueprints.currentItem().text()
-        except AttributeError:
-            # nothing selected
-            return
+        """Add the selected blueprints in available list to known list."""
+        self.add_blueprints(self.selected_available())
 
-        # don't add more than one of each blueprint
-        if selected in self.known_blueprints:
-            return
+    def add_filtered_blueprints(self):
+        """Add every blueprint matching the current category and filter."""
+        category = self.ui.category.currentText()
+        name = self.ui.filter.text()
+        self.add_blueprints(self.blueprints.filter_blueprints(category, name, names_only=True))
 
-        # insert the new item and regenerate the list
-        self.known_blueprints.append(selected)
-        self.known_blueprints.sort()
-        self.ui.known_blueprints.clear()
-        for i in range(len(self.known_blueprints)):
-            self.ui.known_blueprints.addItem(self.known_blueprints[i])
-            if self.known_blueprints[i] == selected:
-                self.ui.known_blueprints.setCurrentRow(i)
+    def add_category_blueprints(self):
+        """Add every blueprint in the current category."""
+        category = self.ui.category.currentText()
+        self.add_blueprints(self.blueprints.filter_blueprints(category, "", names_only=True))
 
-    def remove_blueprint(self):
-        """Remove currently selected blueprint in known list."""
-        try:
-            selected = self.ui.known_blueprints.currentItem().text()
-        except AttributeError:
+    def remove_category_blueprints(self):
+        """Remove every known blueprint in the current category."""
+        category = self.ui.category.currentText()
+        if category == "<all>":
+            # includes ones that aren't in the assets
+            self.remove_blueprints(self.known_blueprints)
+        else:
+            self.remove_blueprints(self.blueprints.filter_blueprints(category, "", names_only=True))
+
+    def add_required_blueprints(self):
+        """Add every blueprint needed to craft the selected blueprints from scratch."""
+        selected = self.selected_available()
+        required = self.blueprints.get_required_blueprints(selected)
+        self.add_blueprints(required + selected)
+
+    def update_recipe_info(self, current):
+        """Show what the current blueprint makes, needs and is used for."""
+        blueprint = self.available.name(current)
+        if blueprint is None:
+            self.ui.recipe_info.setText("")
             return
 
-        # remove item and regen list
-        self.known_blueprints.remove(selected)
-        self.known_blueprints.sort()
-        self.ui.known_blueprints.clear()
-        for blueprint in self.known_blueprints:
-            self.ui.known_blueprints.addItem(blueprint)
+        lines = []
+        for item in self.blueprints.get_outputs(blueprint):
+            lines.append(item + ":")
+            lines.append(recipe_text(self.blueprints, item))
+        self.ui.recipe_info.setText("\n".join(lines))
+
+    def remove_blueprint(self):
+        """Remove the selected blueprints in known list."""
+        rows = self.ui.known_blueprints.selectionModel().selectedRows()
+        self.remove_blueprints([self.known.name(x) for x in rows])
 
     def get_known_list(self):
-        return self.known_blueprints
+        return sorted(self.known_blueprints)
@@ -2,22 +2,36 @@
 Functions shared between GUI dialogs
 """
 
-from PyQt5 import QtCore, QtGui
+import weakref, threading
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import QAbstractTableModel, QAbstractListModel, QMimeData, QModelIndex
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QTableWidgetItem
-from PyQt5.QtGui import QPixmap, QImageReader
 
-import save_file, assets
+import save_file, assets, gui_icons, logs
+
+log = logs.get_logger("gui")
 
 def inv_icon(item_name):
     """Return a QPixmap object of the inventory icon of a given item (if possible)."""
-    icon_file = assets.Items().get_item_icon(item_name)
+    return gui_icons.item_pixmap(item_name)
+
+def recipe_text(blueprints, item_name):
+    """Return a short description of what an item is crafted from and used in."""
+    lines = []
+
+    recipes = {}
+    for blueprint, item, count in blueprints.get_crafted_from(item_name):
+        recipes.setdefault(blueprint, []).append(str(count) + " " + item)
+    for blueprint in sorted(recipes.keys()):
+        lines.append("Crafted from: " + ", ".join(recipes[blueprint]))
 
-    if icon_file == None:
-        return QPixmap()
+    used_in = blueprints.get_used_in(item_name)
+    if len(used_in) > 0:
+        lines.append("Used in: " + ", ".join(used_in))
 
-    reader = QImageReader(icon_file[0])
-    reader.setClipRect(QtCore.QRect(icon_file[1], 0, 16, 16))
-    return QPixmap.fromImageReader(reader).scaled(32, 32)
+    return "\n".join(lines)
 
 def empty_slot():
     """Return an empty bag slot widget."""
@@ -50,14 +64,312 @@ def pretty_variant(variant):
     else:
         return "__UNKNOWN_TYPE__"
 
-# TODO: a decision needs to be made here whether to continue with the custom
-#       widget item or an entirely new custom table view. if the features below
-#       are easy enough to add then we'll just stick with the current method
-# TODO: swap items instead of overwriting
-#       apparently this is done by reimplementing the drag functions
+class NameListModel(QAbstractListModel):
+    def __init__(self, names=(), parent=None, batch=200):
+        """
+        List model of plain names, for the item and blueprint lists. Rows are
+        handed to the view batch at a time as it scrolls, see set_names and
+        set_fetch for where they come from.
+        """
+        QAbstractListModel.__init__(self, parent)
+        self.batch = batch
+        self.set_names(names)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.names)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.names):
+            return None
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return self.names[index.row()]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.complete
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.complete:
+            return
+        start = len(self.names)
+        if self.fetch is None:
+            more = self.pending[start:start + self.batch]
+        else:
+            more = self.fetch(start, self.batch)
+        self.complete = len(more) < self.batch
+        if len(more) == 0:
+            return
+
+        self.beginInsertRows(QModelIndex(), start, start + len(more) - 1)
+        self.names.extend(more)
+        self.endInsertRows()
+
+    def name(self, index):
+        """Return the name in a row, None if it's not valid."""
+        if not index.isValid() or index.row() >= len(self.names):
+            return None
+        return self.names[index.row()]
+
+    def set_names(self, names):
+        """Show a list of names that's already been loaded."""
+        self.beginResetModel()
+        self.names = []
+        self.pending = list(names)
+        self.fetch = None
+        self.complete = len(self.pending) == 0
+        self.endResetModel()
+
+    def set_fetch(self, fetch, first=None):
+        """
+        Load names from fetch(offset, limit) as they're needed, for lists that
+        are too big to get in one go. first is an optional first page that's
+        already been fetched, e.g. in the background.
+        """
+        self.beginResetModel()
+        self.names = []
+        self.pending = []
+        self.fetch = fetch
+        self.complete = False
+        if first is not None:
+            self.names = list(first)
+            self.complete = len(self.names) < self.batch
+        self.endResetModel()
+
+class FilterSearch(QObject):
+    """
+    Runs a search function in the background when the filter changes, with
+    the results sent back to the GUI thread through the found signal.
+    Requests are debounced so a burst of typing only searches once, and a
+    new request cancels any search that's still running. The function has
+    to take a cancel keyword (see assets.AssetsDb.query).
+    """
+    found = pyqtSignal(object)
+    # internal, (search number, results) from the search thread
+    search_done = pyqtSignal(int, object)
+
+    def __init__(self, search, delay=150, parent=None):
+        QObject.__init__(self, parent)
+        self.search = search
+        self.args = ()
+        self.searches = 0
+        self.cancel_event = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.start)
+        self.search_done.connect(self.done)
+
+    def request(self, *args):
+        """Search with args once the filter has stopped changing."""
+        self.args = args
+        self.timer.start()
+
+    def cancel(self):
+        """Stop any waiting or running search, its results are thrown away."""
+        self.timer.stop()
+        self.searches += 1
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_event = None
+
+    def start(self):
+        self.cancel()
+        number = self.searches
+        event = threading.Event()
+        self.cancel_event = event
+        args = self.args
+
+        def run():
+            try:
+                result = self.search(*args, cancel=event)
+            except assets.QueryCancelled:
+                return
+            try:
+                self.search_done.emit(number, result)
+            except RuntimeError:
+                # the dialog was closed while searching
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def done(self, number, result):
+        # anything but the latest search is out of date
+        if number == self.searches:
+            self.cancel_event = None
+            self.found.emit(result)
+
+# mime type of a bag slot being dragged around, the data is
+# "<model id> <row> <column>" of where it came from
+slot_mime_type = "application/x-starcheat-slot"
+
 # TODO: some sort of icon painter so we can show a frame, rarity and count overlay
+class BagModel(QAbstractTableModel):
+    # every bag model by id, so a drop can find where a slot was dragged from
+    models = weakref.WeakValueDictionary()
+
+    def __init__(self, columns, slots=(), parent=None):
+        """
+        Table model over a list of raw bag slots, (name, count, variant), laid
+        out columns wide. Icons are only looked up when a view asks for the
+        cells it's showing. Dragging a slot onto another swaps them, in the
+        same bag or between bags.
+        """
+        QAbstractTableModel.__init__(self, parent)
+        self.columns = columns
+        self.slots = [tuple(x) for x in slots]
+        BagModel.models[id(self)] = self
+        gui_icons.get_icon_loader().icon_ready.connect(self.icon_ready)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return (len(self.slots) + self.columns - 1) // self.columns
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.columns
+
+    def slot_number(self, index):
+        """Return the position in the bag of a cell, None if it's past the end."""
+        if not index.isValid():
+            return None
+        slot = index.row() * self.columns + index.column()
+        if slot >= len(self.slots):
+            return None
+        return slot
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        slot = self.slot_number(index)
+        if slot is None:
+            return None
+        name, count = self.slots[slot][0], self.slots[slot][1]
+        if name == "":
+            return None
+
+        # icons are loaded in the background, icon_ready redraws the cell
+        if role == QtCore.Qt.DecorationRole:
+            icon = gui_icons.item_icon_async(name)
+            if icon is None:
+                return gui_icons.placeholder_icon()
+            return icon
+        elif role == QtCore.Qt.DisplayRole:
+            # only show the name if there isn't an icon
+            icon = gui_icons.item_icon_async(name)
+            if icon is not None and icon.isNull():
+                return name
+            return ""
+        elif role == QtCore.Qt.ToolTipRole:
+            return name + " (" + str(count) + ")"
+        elif role == QtCore.Qt.TextAlignmentRole:
+            return QtCore.Qt.AlignCenter
+        return None
+
+    def flags(self, index):
+        if self.slot_number(index) is None:
+            return QtCore.Qt.NoItemFlags
+        return (QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable |
+                QtCore.Qt.ItemIsDragEnabled | QtCore.Qt.ItemIsDropEnabled)
+
+    def slot(self, index):
+        """Return the raw slot value of a cell."""
+        slot = self.slot_number(index)
+        if slot is None:
+            return save_file.empty_slot()
+        return self.slots[slot]
+
+    def set_slot(self, index, value):
+        """Replace the raw slot value of a cell."""
+        slot = self.slot_number(index)
+        if slot is None:
+            return
+        self.slots[slot] = tuple(value)
+        self.dataChanged.emit(index, index)
+
+    def get_slots(self):
+        """Return the entire contents of the bag as raw values."""
+        return [(x[0], int(x[1]), x[2]) for x in self.slots]
+
+    def set_slots(self, slots):
+        """
+        Replace the entire contents of the bag. Views are only told about the
+        slots that actually changed, unless the bag changed size.
+        """
+        slots = [tuple(x) for x in slots]
+        if len(slots) != len(self.slots):
+            self.beginResetModel()
+            self.slots = slots
+            self.endResetModel()
+            return
+
+        for i in range(len(slots)):
+            if slots[i] != self.slots[i]:
+                self.slots[i] = slots[i]
+                index = self.index(i // self.columns, i % self.columns)
+                self.dataChanged.emit(index, index)
+
+    def icon_ready(self, name):
+        """Redraw every cell holding an item whose icon just loaded."""
+        for i in range(len(self.slots)):
+            if self.slots[i][0] == name:
+                index = self.index(i // self.columns, i % self.columns)
+                self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole,
+                                                     QtCore.Qt.DisplayRole])
+
+    def refresh_icons(self):
+        """Make views ask for every icon again, after they've changed."""
+        if len(self.slots) == 0:
+            return
+        last = self.index(self.rowCount() - 1, self.columns - 1)
+        self.dataChanged.emit(self.index(0, 0), last, [QtCore.Qt.DecorationRole,
+                                                       QtCore.Qt.DisplayRole])
+
+    # drag and drop
+    def supportedDragActions(self):
+        return QtCore.Qt.MoveAction
+
+    def supportedDropActions(self):
+        return QtCore.Qt.MoveAction
+
+    def mimeTypes(self):
+        return [slot_mime_type]
+
+    def mimeData(self, indexes):
+        if len(indexes) == 0:
+            return None
+        index = indexes[0]
+        data = QMimeData()
+        text = "%d %d %d" % (id(self), index.row(), index.column())
+        data.setData(slot_mime_type, text.encode())
+        return data
+
+    def dropMimeData(self, data, action, row, column, parent):
+        if action != QtCore.Qt.MoveAction or not data.hasFormat(slot_mime_type):
+            return False
+        try:
+            model_id, from_row, from_column = [int(x) for x in bytes(data.data(slot_mime_type)).split()]
+            source = BagModel.models[model_id]
+        except (ValueError, KeyError):
+            return False
+
+        # dropped onto a cell, or in the gap next to one
+        target = parent if parent.isValid() else self.index(row, column)
+        origin = source.index(from_row, from_column)
+        if self.slot_number(target) is None or source.slot_number(origin) is None:
+            return False
+
+        # swap the two slots, the view's own move cleanup is a no-op here
+        # since there's no setData or removeRows
+        dragged = source.slot(origin)
+        source.set_slot(origin, self.slot(target))
+        self.set_slot(target, dragged)
+        return True
+
 class ItemWidget(QTableWidgetItem):
-    """Custom table wiget item with icon support and extra item variables."""
+    """Table widget item holding an item's values, used by the item edit dialog."""
     def __init__(self, item):
         self.name = item[0]
         self.item_count = item[1]
@@ -65,20 +377,29 @@ class ItemWidget(QTableWidgetItem):
         QTableWidgetItem.__init__(self, self.name)
         self.setTextAlignment(QtCore.Qt.AlignCenter)
 
-        # TODO: remove this
-        print(self.variant)
+        log.debug("item widget %s variant %r", self.name, self.variant)
 
         if self.name != "":
             self.setToolTip(self.name + " (" + str(self.item_count) + ")")
         else:
             return
 
-        icon = inv_icon(self.name)
-        try:
-            self.setIcon(QtGui.QIcon(icon))
-        except TypeError:
-            pass
+        self.update_icon()
 
-        if type(icon) is QPixmap:
+    def get_slot(self):
+        """Return the item as a raw bag slot value."""
+        return self.name, self.item_count, self.variant
+
+    def update_icon(self):
+        """Load the item's inventory icon, only shows the name if there isn't one."""
+        if self.name == "":
+            return
+
+        icon = gui_icons.item_icon(self.name)
+        self.setIcon(icon)
+
+        if not icon.isNull():
             #self.setText(str(self.item_count))
             self.setText("")
+        else:
+            self.setText(self.name)
@@ -0,0 +1,438 @@
+"""
+Item icon thumbnails
+
+Icons are clipped out of their sprite sheets and scaled once, then packed
+into atlas files saved next to the assets database. Every thumbnail is
+keyed on the asset it came from (layer, path, modified time and rect) so
+it gets remade when that changes.
+"""
+
+import os, json, threading, zlib
+from collections import OrderedDict
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QPainter, QPixmap, QIcon, QColor
+
+import assets, config, profiling
+
+# bump this whenever the atlas layout changes, old atlases are thrown away
+atlas_version = 1
+
+def thumbnail(image, rect, size):
+    """
+    Return a size x size QImage of part of an image, rect is (x, y, w, h) or
+    None for all of it. The image is scaled to fit and centred.
+    """
+    if image.isNull():
+        return QImage()
+    if rect is not None:
+        image = image.copy(QtCore.QRect(*rect))
+    image = image.scaled(size, size, QtCore.Qt.KeepAspectRatio)
+
+    thumb = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+    thumb.fill(QtCore.Qt.transparent)
+    painter = QPainter(thumb)
+    painter.drawImage((size - image.width()) // 2, (size - image.height()) // 2, image)
+    painter.end()
+    return thumb
+
+def thumbnail_key(layer, source, path, rect):
+    """Return a string identifying exactly what a thumbnail was made from."""
+    return "%s:%s:%r:%r" % (layer, path, source.mtime(path), rect)
+
+class IconAtlas():
+    def __init__(self, folder, name, size):
+        """
+        Thumbnails of one size packed into a single atlas file on disk, with
+        an index of item name to where each one is. Thumbnails are stored as
+        compressed raw pixels so getting one back is a seek and a read, no
+        image decoding. Safe to use from more than one thread.
+        """
+        self.folder = folder
+        self.size = size
+        self.atlas_file = os.path.join(folder, "%s_%d.atlas" % (name, size))
+        self.index_file = os.path.join(folder, "%s_%d.json" % (name, size))
+        self.file = None
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the atlas index, starting empty if it's missing or outdated."""
+        with self.lock:
+            # item name -> [offset, length, key]
+            self.icons = {}
+            self.index_dirty = False
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index["version"] == atlas_version and index["size"] == self.size:
+                    self.icons = index["icons"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+            # the index can't point past the end of the atlas
+            try:
+                atlas_size = os.path.getsize(self.atlas_file)
+            except OSError:
+                atlas_size = 0
+            if any([x[0] + x[1] > atlas_size for x in self.icons.values()]):
+                self.icons = {}
+                self.index_dirty = True
+
+    def open(self):
+        if self.file is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.file = open(self.atlas_file, "a+b")
+        return self.file
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def clear(self):
+        """Throw away every thumbnail."""
+        with self.lock:
+            self.close()
+            for filename in (self.atlas_file, self.index_file):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            self.load()
+
+    def has(self, name, key):
+        """Return True if there's a thumbnail for name made from key."""
+        with self.lock:
+            entry = self.icons.get(name)
+            return entry is not None and entry[2] == key
+
+    def get(self, name, key):
+        """Return the thumbnail for name if it was made from key, otherwise None."""
+        with self.lock:
+            entry = self.icons.get(name)
+            if entry is None or entry[2] != key:
+                return None
+            f = self.open()
+            f.seek(entry[0])
+            data = f.read(entry[1])
+
+        pixels = zlib.decompress(data)
+        image = QImage(pixels, self.size, self.size, self.size * 4,
+                       QImage.Format_ARGB32_Premultiplied)
+        # the image only borrows the pixel data
+        return image.copy()
+
+    def put(self, name, key, image):
+        """
+        Store a thumbnail for name made from key, replacing any old one. The
+        old one stays in the atlas file until it's cleared.
+        """
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        bits = image.constBits()
+        bits.setsize(image.byteCount())
+        data = zlib.compress(bytes(bits), 1)
+
+        with self.lock:
+            f = self.open()
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            self.icons[name] = [offset, len(data), key]
+            self.index_dirty = True
+
+    def save(self):
+        """Write the index to disk if anything has been added."""
+        with self.lock:
+            if not self.index_dirty:
+                return
+            self.open().flush()
+
+            index = {
+                "version": atlas_version,
+                "size": self.size,
+                "icons": self.icons
+            }
+            with open(self.index_file + ".tmp", "w") as f:
+                json.dump(index, f)
+            os.replace(self.index_file + ".tmp", self.index_file)
+            self.index_dirty = False
+
+atlases = {}
+atlases_lock = threading.Lock()
+
+def get_atlas(kind, size):
+    """
+    Return the shared atlas for a kind of thumbnail ("icon" or "image") at
+    a size. They live in an icons folder next to the assets database.
+    """
+    with atlases_lock:
+        if (kind, size) not in atlases:
+            folder = os.path.join(os.path.dirname(config.Config().read("assets_db")), "icons")
+            atlases[(kind, size)] = IconAtlas(folder, kind, size)
+        return atlases[(kind, size)]
+
+def save_atlases():
+    with atlases_lock:
+        for atlas in atlases.values():
+            atlas.save()
+
+def item_thumbnail(name, kind="icon", size=32):
+    """
+    Return a QImage thumbnail of an item's inventory icon (or image), null if
+    it doesn't have one. Comes out of the atlas when it's up to date,
+    otherwise it's made and added to it.
+    """
+    items = assets.Items()
+    found = getattr(items, "get_item_" + kind)(name)
+    if found is None:
+        return QImage()
+    path, rect = found
+    layer = items.find_asset(path)
+    source = items.layer_source(layer)
+
+    atlas = get_atlas(kind, size)
+    try:
+        key = thumbnail_key(layer, source, path, rect)
+        thumb = atlas.get(name, key)
+        if thumb is None:
+            profiling.count("icon atlas misses")
+            with profiling.stage("icons.decode") as stage:
+                data = source.read(path)
+                stage.nbytes = len(data)
+                thumb = thumbnail(QImage.fromData(data), rect, size)
+            if not thumb.isNull():
+                atlas.put(name, key, thumb)
+        else:
+            profiling.count("icon atlas hits")
+    except (OSError, ValueError):
+        # the file went away since it was looked up (a mod was updated or
+        # removed), or its archive was closed
+        return QImage()
+    return thumb
+
+class PixmapCache():
+    def __init__(self, budget):
+        """
+        In memory cache of item pixmaps (and QIcons made from them), keyed on
+        (item name, kind, size). The least recently used ones get dropped
+        once they take up more than budget bytes. Pixmaps only work in the
+        GUI thread so that's the only place this should be used.
+        """
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.used = 0
+
+    def cost(self, pixmap):
+        # empty pixmaps for items without icons still cost something
+        return max(pixmap.width() * pixmap.height() * pixmap.depth() // 8, 64)
+
+    def get(self, key):
+        """Return a cached [pixmap, icon] and mark it recently used. Raises KeyError."""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            profiling.count("pixmap cache misses")
+            raise
+        profiling.count("pixmap cache hits")
+        self.entries[key] = entry
+        return entry
+
+    def put(self, key, pixmap):
+        """Add a pixmap to the cache and return its [pixmap, icon] entry."""
+        if key in self.entries:
+            self.used -= self.cost(self.entries.pop(key)[0])
+        entry = [pixmap, None]
+        self.entries[key] = entry
+        self.used += self.cost(pixmap)
+        while self.used > self.budget and len(self.entries) > 1:
+            self.used -= self.cost(self.entries.popitem(last=False)[1][0])
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.used = 0
+
+pixmap_cache = None
+
+def get_pixmap_cache():
+    """Return the process wide PixmapCache, sized from the icon_cache_mb option."""
+    global pixmap_cache
+    if pixmap_cache is None:
+        try:
+            budget = float(config.Config().read().get("icon_cache_mb", config.icon_cache_mb))
+        except ValueError:
+            budget = float(config.icon_cache_mb)
+        pixmap_cache = PixmapCache(int(budget * 1024 * 1024))
+    return pixmap_cache
+
+def clear_pixmaps():
+    """Forget every cached pixmap, they need to be reloaded after indexing."""
+    get_pixmap_cache().clear()
+
+def pixmap_entry(name, kind, size):
+    cache = get_pixmap_cache()
+    key = (name, kind, size)
+    try:
+        return cache.get(key)
+    except KeyError:
+        return cache.put(key, QPixmap.fromImage(item_thumbnail(name, kind, size)))
+
+def item_pixmap(name, kind="icon", size=32):
+    """Return a cached QPixmap thumbnail of an item, null if it doesn't have one."""
+    return pixmap_entry(name, kind, size)[0]
+
+def item_icon(name, size=32):
+    """Return a cached QIcon of an item's inventory icon, null if it doesn't have one."""
+    entry = pixmap_entry(name, "icon", size)
+    if entry[1] is None:
+        entry[1] = QIcon(entry[0])
+    return entry[1]
+
+class IconJob(QRunnable):
+    def __init__(self, loader, key):
+        """Makes one (name, kind, size) thumbnail on the loader's thread pool."""
+        QRunnable.__init__(self)
+        self.loader = loader
+        self.key = key
+
+    def run(self):
+        try:
+            image = item_thumbnail(*self.key)
+        except Exception:
+            # still install something, otherwise it would never be asked
+            # for again
+            image = QImage()
+        self.loader.loaded.emit(self.key, image)
+
+class IconLoader(QObject):
+    """
+    Makes item thumbnails on a pool of worker threads. They come back as
+    QImages and get turned into pixmaps in the pixmap cache on the GUI
+    thread, then icon_ready is sent with the item name so views can redraw.
+    """
+    icon_ready = pyqtSignal(str)
+    # internal, ((name, kind, size), QImage) from a worker
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.pool = QThreadPool(self)
+        self.pending = set()
+        self.loaded.connect(self.install)
+
+    def request(self, key):
+        """Start making a (name, kind, size) thumbnail if it isn't already."""
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        self.pool.start(IconJob(self, key))
+
+    def install(self, key, image):
+        self.pending.discard(key)
+        get_pixmap_cache().put(key, QPixmap.fromImage(image))
+        self.icon_ready.emit(key[0])
+
+    def stop(self):
+        """Drop anything not started yet and wait for the rest."""
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.pending.clear()
+
+icon_loader = None
+
+def get_icon_loader():
+    """Return the process wide IconLoader, first use has to be on the GUI thread."""
+    global icon_loader
+    if icon_loader is None:
+        icon_loader = IconLoader()
+    return icon_loader
+
+def stop_loading():
+    if icon_loader is not None:
+        icon_loader.stop()
+
+placeholders = {}
+
+def placeholder_icon(size=32):
+    """Return a faint square to show while an icon is loading."""
+    if size not in placeholders:
+        pixmap = QPixmap(size, size)
+        pixmap.fill(QtCore.Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.fillRect(size // 4, size // 4, size // 2, size // 2, QColor(128, 128, 128, 48))
+        painter.end()
+        placeholders[size] = QIcon(pixmap)
+    return placeholders[size]
+
+def item_icon_async(name, size=32):
+    """
+    Return a cached QIcon of an item's inventory icon (null if it doesn't
+    have one), or None if it isn't loaded yet. In that case it's loaded in
+    the background and IconLoader.icon_ready is sent when it's ready.
+    """
+    try:
+        entry = get_pixmap_cache().get((name, "icon", size))
+    except KeyError:
+        get_icon_loader().request((name, "icon", size))
+        return None
+    if entry[1] is None:
+        entry[1] = QIcon(entry[0])
+    return entry[1]
+
+@profiling.timed("index.icons")
+def build_icon_atlas(progress=None, clear=False, size=32):
+    """
+    Make inventory icon thumbnails for every indexed item that doesn't have
+    an up to date one yet. Items are grouped by icon so each sprite sheet
+    only gets decoded once. Meant to run in the background after indexing,
+    progress is an optional assets.IndexProgress.
+    """
+    if progress is None:
+        progress = assets.IndexProgress()
+
+    atlas = get_atlas("icon", size)
+    if clear:
+        atlas.clear()
+
+    items = assets.Items()
+    layers = [(layer, assets.get_source(path)) for layer, path in items.get_layers()]
+    q = """select name, icon, icon_x, icon_y, icon_w, icon_h from items
+           where active = 1 order by icon"""
+    rows = items.db.query(q)
+    progress.icons_total = len(rows)
+    progress.report(True)
+
+    # highest priority layer with each icon
+    found = {}
+    sheet_path = None
+    sheet = None
+    for row in rows:
+        name, path = row[0], row[1]
+        rect = None if row[2] is None else tuple(row[2:])
+
+        if path not in found:
+            found[path] = None
+            for layer in layers:
+                if layer[1].exists(path):
+                    found[path] = layer
+                    break
+        progress.icons += 1
+        progress.report()
+        if found[path] is None:
+            continue
+
+        layer, source = found[path]
+        key = thumbnail_key(layer, source, path, rect)
+        if atlas.has(name, key):
+            continue
+
+        if path != sheet_path:
+            sheet = QImage.fromData(source.read(path))
+            sheet_path = path
+        thumb = thumbnail(sheet, rect, size)
+        if not thumb.isNull():
+            atlas.put(name, key, thumb)
+
+    atlas.save()
+    progress.report(True)
@@ -2,12 +2,160 @@
 Qt item browser dialog
 """
 
-from PyQt5.QtWidgets import QDialog, QTableWidgetItem
-from PyQt5.QtGui import QPixmap
+import threading
+from collections import namedtuple
 
-import assets, qt_itembrowser
+from PyQt5 import QtCore
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QObject, pyqtSignal
+from PyQt5.QtWidgets import QDialog
+from PyQt5.QtGui import QPixmap, QImage
+
+import assets, qt_itembrowser, gui_icons, logs
 from gui_common import *
 
+log = logs.get_logger("gui")
+
+# everything the details view shows about an item. image is a QImage since
+# these are made in a background thread
+ItemDetails = namedtuple("ItemDetails", ("name", "short_desc", "description",
+                                         "image", "recipe", "info"))
+
+def load_item_details(items, blueprints, name):
+    """Return ItemDetails for an item. Safe to call from any thread."""
+    try:
+        item = items.get_item(name)[0]
+    except (TypeError, OSError, ValueError):
+        # not in the db anymore or the asset is gone
+        item = {}
+
+    image = gui_icons.item_thumbnail(name, "image", 64)
+    # fallback on inventory icon
+    if image.isNull():
+        image = gui_icons.item_thumbnail(name, "icon", 32)
+    # last ditch, just use x.png
+    if image.isNull():
+        try:
+            image = QImage.fromData(items.read_asset(items.missing_icon()))
+        except (FileNotFoundError, TypeError):
+            pass
+
+    info = []
+    for key in sorted(item.keys()):
+        info.append(str(key) + ": " + str(item[key]))
+
+    return ItemDetails(name,
+                       item.get("shortdescription", "Missing short description"),
+                       item.get("description", "Missing description"),
+                       image,
+                       recipe_text(blueprints, name),
+                       info)
+
+class DetailLoader(QObject):
+    """
+    Loads ItemDetails in a background thread, sending them back through the
+    loaded signal. Recent results are kept so going back to an item is
+    instant, and neighbouring items can be loaded ahead of time.
+    """
+    loaded = pyqtSignal(object)
+
+    def __init__(self, items, blueprints, parent=None, size=128):
+        QObject.__init__(self, parent)
+        self.items = items
+        self.blueprints = blueprints
+        self.cache = assets.LookupCache(size)
+
+        self.lock = threading.Condition()
+        # the item that's wanted now, and ones that might be soon
+        self.wanted = None
+        self.prefetch = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, name, prefetch=()):
+        """Load details for name, then for each of prefetch."""
+        try:
+            self.loaded.emit(self.cache.get(name))
+            wanted = None
+        except KeyError:
+            wanted = name
+
+        with self.lock:
+            self.wanted = wanted
+            self.prefetch = [x for x in prefetch if x is not None]
+            self.lock.notify()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.stopped and self.wanted is None and len(self.prefetch) == 0:
+                    self.lock.wait()
+                if self.stopped:
+                    return
+                if self.wanted is not None:
+                    name, emit = self.wanted, True
+                    self.wanted = None
+                else:
+                    name, emit = self.prefetch.pop(0), False
+
+            try:
+                details = self.cache.get(name)
+            except KeyError:
+                try:
+                    details = load_item_details(self.items, self.blueprints, name)
+                    self.cache.put(name, details)
+                except Exception:
+                    # keep going, otherwise nothing would ever load again.
+                    # not cached so it's tried again next time
+                    log.exception("Couldn't load details of %s", name)
+                    details = ItemDetails(name, name, "Couldn't load item details",
+                                          QImage(), "", [])
+
+            if emit:
+                try:
+                    self.loaded.emit(details)
+                except RuntimeError:
+                    # the dialog was closed while loading
+                    return
+
+class ItemInfoModel(QAbstractTableModel):
+    def __init__(self, parent=None):
+        """Single column model of an item's default options."""
+        QAbstractTableModel.__init__(self, parent)
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return 1
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return self.rows[index.row()]
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return "Default Options"
+        return None
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.endResetModel()
+
 class ItemBrowser():
     def __init__(self, parent):
         """Dialog for viewing/searching indexed items and returning selection."""
@@ -17,83 +165,93 @@ class ItemBrowser():
 
         self.item_browse_select = None
         self.items = assets.Items()
+        self.blueprints = assets.Blueprints()
 
         # populate category combobox
         for cat in self.items.get_categories():
             self.ui.category.addItem(cat[0])
+        for rarity in assets.rarities:
+            self.ui.rarity.addItem(rarity)
 
-        # populate initial items list
-        self.ui.items.clear()
-        for item in self.items.get_all_items():
-            self.ui.items.addItem(item[0])
+        # populate initial items list, it's only read in as it's scrolled
+        self.model = NameListModel(parent=self.dialog)
+        self.model.set_fetch(self.items.get_item_names)
+        self.ui.items.setModel(self.model)
 
-        self.ui.items.itemSelectionChanged.connect(self.update_item_view)
+        # filtering happens in the background as the user types
+        self.filter_search = FilterSearch(self.search_items, parent=self.dialog)
+        self.filter_search.found.connect(self.set_item_list)
+        self.dialog.finished.connect(self.filter_search.cancel)
+
+        # item details are loaded in the background
+        self.info = ItemInfoModel(self.dialog)
+        self.ui.info.setModel(self.info)
+        self.detail_loader = DetailLoader(self.items, self.blueprints, self.dialog)
+        self.detail_loader.loaded.connect(self.show_item_details)
+        self.dialog.finished.connect(self.detail_loader.stop)
+
+        self.ui.items.selectionModel().currentChanged.connect(self.update_item_view)
         self.ui.filter.textChanged.connect(self.update_item_list)
         self.ui.category.currentTextChanged.connect(self.update_item_list)
+        self.ui.rarity.currentTextChanged.connect(self.update_item_list)
+        self.ui.sort.currentTextChanged.connect(self.update_item_list)
 
-        self.ui.items.setCurrentRow(0)
+        self.model.fetchMore()
+        self.ui.items.setCurrentIndex(self.model.index(0))
         self.ui.filter.setFocus()
 
     def update_item_view(self):
-        """Update item details view with data from currently selected item."""
-        try:
-            selected = self.ui.items.selectedItems()[0].text()
-        except IndexError:
+        """Load details of the currently selected item, and the ones next to it."""
+        current = self.ui.items.currentIndex()
+        selected = self.model.name(current)
+        if selected is None:
             return
+        self.item_browse_select = selected
 
-        item = self.items.get_item(selected)
-        # don't like so many queries but should be ok for the browser
-        icon_file = self.items.get_item_image(selected)
-        # fallback on inventory icon
-        if icon_file == None:
-            icon = inv_icon(selected)
-        else:
-            icon = QPixmap(icon_file).scaledToHeight(64)
-
-        # last ditch, just use x.png
-        try:
-            self.ui.item_icon.setPixmap(icon)
-        except TypeError:
-            self.ui.item_icon.setPixmap(QPixmap(self.items.missing_icon()))
+        # most likely to be looked at next when using the arrow keys
+        neighbours = []
+        for offset in (1, -1, 2, -2):
+            neighbours.append(self.model.name(current.sibling(current.row() + offset, 0)))
+        self.detail_loader.request(selected, neighbours)
 
-        self.item_browse_select = selected
+    def show_item_details(self, details):
+        """Update item details view with loaded ItemDetails."""
+        # the selection might have moved on while it was loading
+        if details.name != self.item_browse_select:
+            return
 
+        self.ui.item_icon.setPixmap(QPixmap.fromImage(details.image))
         # TODO: update qt objectnames, already not making sense
-        try:
-            self.ui.item_name.setText(item[0]["shortdescription"])
-        except KeyError:
-            self.ui.item_name.setText("Missing short description")
-
-        try:
-            self.ui.short_desc.setText(item[0]["description"])
-        except KeyError:
-            self.ui.short_desc.setText("Missing description")
+        self.ui.item_name.setText(details.short_desc)
+        self.ui.short_desc.setText(details.description)
+        self.ui.recipe_info.setText(details.recipe)
 
         # populate default variant table
-        row = 0
-        self.ui.info.setRowCount(len(item[0]))
-        for key in sorted(item[0].keys()):
-            try:
-                text = str(key) + ": " + str(item[0][key])
-                table_item = QTableWidgetItem(text)
-                table_item.setToolTip(text)
-                self.ui.info.setItem(row, 0, table_item)
-            except TypeError:
-                pass
-            row += 1
+        self.info.set_rows(details.info)
 
     def update_item_list(self):
-        """Populate item list based on current filter details."""
+        """Search for items matching the current filter details."""
         category = self.ui.category.currentText()
         name = self.ui.filter.text()
-        result = self.items.filter_items(category, name)
+        rarity = self.ui.rarity.currentText()
+        sort = self.ui.sort.currentText()
+        self.filter_search.request(category, name, rarity, sort)
+
+    def search_items(self, category, name, rarity, sort, cancel=None):
+        # runs in the background, see FilterSearch. only the first page is
+        # fetched here, the rest as the list is scrolled
+        def fetch(offset, limit, cancel=None):
+            return self.items.filter_items(category, name, rarity, sort, cancel=cancel,
+                                           names_only=True, offset=offset, limit=limit)
+        return fetch(0, self.model.batch, cancel), fetch
 
+    def set_item_list(self, result):
+        """Populate item list with the result of a search."""
         # TODO: i'd like this to set focus on the list when category is changed
         #       but not when the edit box is changed (split this function)
-        self.ui.items.clear()
-        for item in result:
-            self.ui.items.addItem(item[0])
-        self.ui.items.setCurrentRow(0)
+        first, fetch = result
+        self.model.set_fetch(fetch, first)
+        self.ui.items.setCurrentIndex(self.model.index(0))
 
     def get_selection(self):
         return self.item_browse_select
@@ -6,9 +6,13 @@ from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QDialog, QTableWidgetItem, QInputDialog
 from PyQt5.QtGui import QPixmap
 
-import assets, qt_itemedit
+import assets, qt_itemedit, logs
 from gui_common import *
-from gui_itembrowser import *
+
+log = logs.get_logger("itemedit")
+
+# used when an item doesn't set maxStack
+default_max_stack = 1000
 
 class ItemVariant(QTableWidgetItem):
     def __init__(self, variant):
@@ -19,8 +23,7 @@ class ItemVariant(QTableWidgetItem):
         item_text = self.variant_name + ": " + pretty_variant(variant[1])
         QTableWidgetItem.__init__(self, item_text)
         self.setToolTip(item_text)
-        # TODO: remove this
-        print(variant)
+        log.debug("variant %r", variant)
 
     def get_variant(self):
         """Return the full variant in the proper format."""
@@ -81,6 +84,7 @@ class ItemEdit():
             self.ui.short_desc.setText("")
             self.ui.desc.setText("")
             self.ui.icon.setPixmap(QPixmap())
+            self.ui.count.setMaximum(default_max_stack)
             clear_variants()
             return
 
@@ -100,6 +104,12 @@ class ItemEdit():
             # TODO: change this to the x.png?
             self.ui.icon.setPixmap(QPixmap())
 
+        # don't allow more than a full stack
+        max_stack = assets.Items().get_item_meta(name)[2]
+        if max_stack is None:
+            max_stack = default_max_stack
+        self.ui.count.setMaximum(max(1, max_stack))
+
         clear_variants()
 
     def get_item(self):
@@ -109,7 +119,7 @@ class ItemEdit():
 
         variant_rows = self.ui.variant.rowCount()
         variant = []
-        print(variant_rows)
+        log.debug("%d variant rows", variant_rows)
         for i in range(variant_rows):
             cell = self.ui.variant.item(i, 0)
             variant.append(cell.get_variant())
@@ -117,13 +127,13 @@ class ItemEdit():
         return ItemWidget((type_name, count, (7, variant)))
 
     def new_item_browser(self):
+        from gui_itembrowser import ItemBrowser
         self.item_browser = ItemBrowser(self.dialog)
         self.item_browser.dialog.accepted.connect(self.set_item_browser_selection)
         self.item_browser.dialog.show()
 
     def set_item_browser_selection(self):
         self.ui.item_type.setText(self.item_browser.get_selection())
-        # TODO: stuff like setting value max to maxstack
         self.ui.count.setValue(1)
 
     def edit_variant(self):
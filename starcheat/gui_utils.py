@@ -2,13 +2,18 @@
 Utility dialogs for starcheat itself
 """
 
-import sys, os
-from PyQt5.QtWidgets import QDialog, QFileDialog, QMessageBox
+import sys, os, time, struct
+from PyQt5 import QtCore
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtWidgets import QDialog, QFileDialog, QMessageBox, QProgressDialog
+from PyQt5.QtWidgets import QTreeWidgetItem, QHeaderView
 
 from config import Config
-import save_file, assets
+import save_file, assets, gui_icons, logs
 import qt_options, qt_openplayer
 
+log = logs.get_logger("gui")
+
 class OptionsDialog():
     def __init__(self, parent):
         # TODO: all the other dialogs should match this naming style
@@ -62,20 +67,144 @@ class OptionsDialog():
             return False
         return True
 
-    # TODO: this doesn't work in windows at all because of file locks
-    # need to make a function to drop and recreate the databases
-    # instead of just trashing the file
     def rebuild_db(self):
+        # the main window does the actual indexing in the background
         self.write()
-        if os.path.isfile(self.config["assets_db"]):
-            os.remove(self.config["assets_db"])
-        assets.AssetsDb()
-        # TODO: i want some feedback here
+
+class IndexWorker(QThread):
+    """Builds or updates the assets database in a background thread."""
+    progress = pyqtSignal(object)
+
+    def __init__(self, parent, rebuild=False):
+        QThread.__init__(self, parent)
+        self.rebuild = rebuild
+        self.index_progress = assets.IndexProgress(self.progress.emit)
+        # empty if everything went fine
+        self.error = ""
+
+    def run(self):
+        db = assets.get_assets_db(refresh=False)
+        try:
+            if self.rebuild:
+                db.rebuild_db(self.index_progress)
+            else:
+                db.refresh(self.index_progress)
+            gui_icons.build_icon_atlas(self.index_progress, self.rebuild)
+        except assets.IndexCancelled as e:
+            self.error = str(e)
+        except Exception as e:
+            self.error = "Asset indexing failed: " + str(e)
+
+    def cancel(self):
+        self.index_progress.cancel()
+
+class IndexDialog():
+    def __init__(self, parent, rebuild=False):
+        """Non-modal progress dialog for indexing assets in the background."""
+        self.dialog = QProgressDialog("Looking for assets...", "Cancel", 0, 0, parent)
+        self.dialog.setWindowTitle("Indexing Assets")
+        self.dialog.setWindowModality(QtCore.Qt.NonModal)
+        self.dialog.setAutoClose(False)
+        self.dialog.setAutoReset(False)
+        self.dialog.setMinimumDuration(0)
+
+        self.worker = IndexWorker(parent, rebuild)
+        self.worker.progress.connect(self.update)
+        self.worker.finished.connect(self.dialog.close)
+        self.dialog.canceled.connect(self.worker.cancel)
+
+    def start(self):
+        self.dialog.show()
+        self.worker.start()
+
+    def update(self, progress):
+        if progress.icons_total > 0:
+            self.dialog.setMaximum(progress.icons_total)
+            self.dialog.setValue(progress.icons)
+            self.dialog.setLabelText("Checked %d of %d item icons" % (progress.icons,
+                                                                     progress.icons_total))
+            return
+
+        done = progress.parsed + progress.failed
+        self.dialog.setMaximum(max(progress.discovered, 1))
+        self.dialog.setValue(min(done, progress.discovered))
+
+        text = "Indexed %d of %d files (%d failed)\n%d rows written" % (done,
+                                                                       progress.discovered,
+                                                                       progress.failed,
+                                                                       progress.rows)
+        eta = progress.eta()
+        if eta is not None:
+            text += ", about %d seconds left" % (eta)
+        self.dialog.setLabelText(text)
+
+    def is_running(self):
+        return self.worker.isRunning()
+
+    def stop(self):
+        """Cancel indexing and wait for the worker to finish."""
+        self.worker.cancel()
+        self.worker.wait()
+
+class PlayerScanWorker(QThread):
+    """
+    Finds player saves in a background thread, sending a
+    (filename, name, modified time, play time) summary of each one as it's
+    read. Only the start of each save is decoded.
+    """
+    found = pyqtSignal(object)
+
+    def __init__(self, parent, player_folder):
+        QThread.__init__(self, parent)
+        self.player_folder = player_folder
+        self.stopped = False
+
+    def run(self):
+        try:
+            files = [x for x in os.scandir(self.player_folder) if x.name.endswith(".player")]
+        except OSError:
+            return
+
+        for f in files:
+            if self.stopped:
+                return
+            try:
+                player = save_file.PlayerSave(f.path, until="play_time")
+                mtime = f.stat().st_mtime
+            except save_file.WrongSaveVer:
+                log.info("Wrong save version for file: %s", f.name)
+                # don't worry, it won't add it
+                continue
+            except (OSError, IndexError, UnicodeDecodeError, struct.error):
+                # not readable, or not a save at all
+                continue
+            self.found.emit((f.path, player.get_name(), mtime, player.get_play_time()))
+
+    def stop(self):
+        """
+        Ask the scan to stop, without waiting. It can be stuck on slow i/o
+        (like a network home folder), it finishes on its own and is deleted
+        then.
+        """
+        self.stopped = True
+
+class PlayerItem(QTreeWidgetItem):
+    """Player list row that sorts dates and play times by value, not text."""
+    def __init__(self, summary):
+        self.filename, name, mtime, play_time = summary
+        hours, minutes = divmod(int(play_time) // 60, 60)
+        QTreeWidgetItem.__init__(self, [name,
+                                        time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime)),
+                                        "%d:%02d" % (hours, minutes)])
+        self.sort_keys = (name.lower(), mtime, play_time)
+
+    def __lt__(self, other):
+        column = self.treeWidget().sortColumn()
+        return self.sort_keys[column] < other.sort_keys[column]
 
 # TODO: not sure the check for no players found is working? if user forgets
 #       to set a player_folder on setup they will be forced to edit the ini
 # TODO: put error messages in quick dialogs?
-# TODO: support stuff like sorting by date (add column to table widget)
 # TODO: disable the ok button until a valid item is selected
 class CharacterSelectDialog():
     def __init__(self, parent):
@@ -90,35 +219,46 @@ class CharacterSelectDialog():
         # bizarre, if i set this to self.accpet it just doesn't work...
         self.ui.player_list.itemDoubleClicked.connect(self.dialog.accept)
 
-        self.get_players()
-        self.populate()
+        # most recently played first
+        self.ui.player_list.sortByColumn(1, QtCore.Qt.DescendingOrder)
+        self.ui.player_list.header().setStretchLastSection(False)
+        self.ui.player_list.header().setSectionResizeMode(0, QHeaderView.Stretch)
+
+        # saves are read in the background and show up as they're found
+        self.players = 0
+        self.none_found = False
+        self.scanning = True
+        # parented to the main window so it can outlive the dialog
+        self.worker = PlayerScanWorker(parent, self.player_folder)
+        self.worker.found.connect(self.add_player)
+        self.worker.finished.connect(self.scan_finished)
+        self.worker.finished.connect(self.worker.deleteLater)
+        self.dialog.finished.connect(self.stop_scan)
+
+    def stop_scan(self):
+        # anything the worker still sends is ignored from here on
+        self.scanning = False
+        self.worker.stop()
 
     def accept(self):
-        player = self.ui.player_list.currentItem().text()
-        if player != "":
-            self.selected = self.players[player]
+        player = self.ui.player_list.currentItem()
+        if player is not None:
+            self.selected = save_file.PlayerSave(player.filename)
             self.dialog.close()
 
-    def get_players(self):
-        players_found = {}
+    def add_player(self, summary):
+        if not self.scanning:
+            return
+        self.ui.player_list.addTopLevelItem(PlayerItem(summary))
+        self.players += 1
+        if self.ui.player_list.currentItem() is None:
+            self.ui.player_list.setCurrentItem(self.ui.player_list.topLevelItem(0))
 
-        try:
-            for f in os.listdir(self.player_folder):
-                if f.endswith(".player"):
-                    try:
-                        player = save_file.PlayerSave(os.path.join(self.player_folder, f))
-                        players_found[player.get_name()] = player
-                    except save_file.WrongSaveVer:
-                        print("WrongSaveVer for file: %s" % (f))
-                        # don't worry, it won't add it
-        except FileNotFoundError:
-            pass
-
-        self.players = players_found
-
-    def populate(self):
-        for player in self.players.keys():
-            self.ui.player_list.addItem(player)
+    def scan_finished(self):
+        # nothing to pick from, show() offers to find a save manually
+        if self.scanning and self.players == 0:
+            self.none_found = True
+            self.dialog.reject()
 
     def manual_select(self):
         manual_select = QFileDialog.getOpenFileName(None,
@@ -128,8 +268,11 @@ class CharacterSelectDialog():
         return manual_select
 
     def show(self):
+        self.worker.start()
+        self.dialog.exec()
+
         # quit if there are no players
-        if len(self.players) == 0:
+        if self.none_found:
             dialog = QMessageBox()
             msg = "No compatible save files found in: %s" % (self.player_folder)
             dialog.setText(msg)
@@ -137,5 +280,3 @@ class CharacterSelectDialog():
             manual_player = self.manual_select()
             if manual_player[0] != "":
                 self.selected = save_file.PlayerSave(manual_player[0])
-        else:
-            self.dialog.exec()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Command line asset indexer
+
+Builds, checks and updates the assets database without the GUI (or PyQt5),
+and moves prebuilt databases between machines as snapshots. Uses the
+starcheat.ini settings unless they're overridden on the command line.
+"""
+
+import argparse, sys, time
+
+import assets, logs, profiling
+
+def print_progress(progress):
+    done = progress.parsed + progress.failed
+    sys.stderr.write("\r%d/%d files indexed, %d failed, %d rows" % (done,
+                                                                   progress.discovered,
+                                                                   progress.failed,
+                                                                   progress.rows))
+    sys.stderr.flush()
+
+def open_db(args):
+    """Return an AssetsDb for the command line options."""
+    layers = None
+    if args.assets is not None or args.mods is not None:
+        layers = assets.get_layers(args.assets, args.mods)
+    return assets.AssetsDb(args.db, layers)
+
+def build(db, args):
+    start = time.perf_counter()
+    db.rebuild_db(assets.IndexProgress(print_progress))
+    sys.stderr.write("\n")
+    print("Built %s in %.2fs" % (db.assets_db, time.perf_counter() - start))
+
+def update(db, args):
+    start = time.perf_counter()
+    if db.needs_build():
+        db.init_db(assets.IndexProgress(print_progress))
+        sys.stderr.write("\n")
+        print("Built %s in %.2fs" % (db.assets_db, time.perf_counter() - start))
+        return
+
+    changes = db.update_layers(True, assets.IndexProgress(print_progress))
+    if not changes.changed():
+        print("Already up to date")
+        return
+    if len(changes.reindexed) > 0:
+        sys.stderr.write("\n")
+    for verb, names in (("Reindexed", changes.reindexed), ("Dropped", changes.dropped),
+                        ("Reordered", changes.reordered)):
+        if len(names) > 0:
+            print("%s %s" % (verb, ", ".join(names)))
+    print("Updated %s in %.2fs" % (db.assets_db, time.perf_counter() - start))
+
+def verify(db, args):
+    problems = db.verify()
+    for problem in problems:
+        print(problem)
+    if len(problems) > 0:
+        return 1
+    print("%s is up to date" % db.assets_db)
+
+def export_snapshot(db, args):
+    db.export_snapshot(args.snapshot)
+    print("Exported %s to %s" % (db.assets_db, args.snapshot))
+
+def import_snapshot(db, args):
+    db.import_snapshot(args.snapshot, args.force)
+    print("Imported %s to %s" % (args.snapshot, db.assets_db))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and maintain the starcheat assets database.")
+    parser.add_argument("--db", help="assets database file (default from starcheat.ini)")
+    parser.add_argument("--assets", help="Starbound assets folder or .pak file")
+    parser.add_argument("--mod", dest="mods", action="append", metavar="PATH",
+                        help="mod folder or .pak file, can be repeated (lowest priority first)")
+    parser.add_argument("--no-mods", dest="mods", action="store_const", const=[],
+                        help="only index the base assets")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show info log messages (see also STARCHEAT_LOG_LEVEL)")
+    parser.add_argument("--profile", action="store_const", const="yes",
+                        help="time each stage and write a report to profile.txt on exit")
+    parser.add_argument("--cprofile", dest="profile", action="store_const", const="cprofile",
+                        help="like --profile but also run cProfile")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("build", help="index everything from scratch")
+    commands.add_parser("update", help="reindex only new or changed layers")
+    commands.add_parser("verify", help="check the database is complete and up to date")
+    export_parser = commands.add_parser("export", help="write a snapshot of the database")
+    export_parser.add_argument("snapshot")
+    import_parser = commands.add_parser("import", help="replace the database with a snapshot")
+    import_parser.add_argument("snapshot")
+    import_parser.add_argument("--force", action="store_true",
+                               help="import even if the assets look different")
+
+    args = parser.parse_args(argv)
+    logs.setup("info" if args.verbose else None)
+    profiling.start(args.profile or profiling.get_mode([]))
+    actions = {
+        "build": build,
+        "update": update,
+        "verify": verify,
+        "export": export_snapshot,
+        "import": import_snapshot
+    }
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    db = open_db(args)
+    try:
+        return actions[args.command](db, args)
+    except (assets.SnapshotError, assets.IndexCancelled) as e:
+        print(e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        print("\nCancelled", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""
+Logging setup
+
+Every module logs to its own "starcheat.<module>" logger so each part can be
+turned up on its own. Nothing is formatted unless the level is enabled, so
+debug calls are fine in hot paths.
+"""
+
+import logging, os
+
+import config
+
+levels = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR
+}
+
+def get_logger(name):
+    """Return the logger for a part of starcheat, e.g. get_logger("assets")."""
+    return logging.getLogger("starcheat." + name)
+
+def setup(level=None):
+    """
+    Send log messages to stderr. level is one of levels, by default it comes
+    from the STARCHEAT_LOG_LEVEL environment variable or the log_level option.
+    Subsystems can be set separately in the environment variable, e.g.
+    "info,assets=debug".
+    """
+    if level is None:
+        level = os.environ.get("STARCHEAT_LOG_LEVEL")
+    if level is None:
+        try:
+            level = config.Config().read().get("log_level", config.log_level)
+        except KeyError:
+            level = config.log_level
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger("starcheat")
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+
+    for part in level.split(","):
+        name, _, value = part.strip().rpartition("=")
+        value = levels.get(value.lower())
+        if value is None:
+            continue
+        if name == "":
+            root.setLevel(value)
+        else:
+            get_logger(name).setLevel(value)
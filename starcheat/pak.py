@@ -0,0 +1,95 @@
+"""
+Read Starbound packed asset files (.pak) without unpacking them
+
+The archive is memory mapped and only its file index is read up front, file
+contents are sliced straight out of the map when they're asked for.
+
+Format (SBAsset6):
+<8 byte "SBAsset6"><>Q index offset><file data...>
+and at the index offset:
+<5 byte "INDEX"><variant dict metadata><vlq no. files><file entry>...
+where a file entry is:
+<vlq str path><>Q offset><>Q length>
+"""
+
+import mmap
+from struct import unpack_from
+
+from save_file import unpack_vlq, unpack_variant7
+
+pak_header = b"SBAsset6"
+index_header = b"INDEX"
+
+class WrongPakVer(Exception):
+    pass
+
+class PakFile():
+    def __init__(self, filename):
+        """Memory mapped Starbound asset archive."""
+        self.filename = filename
+        self.file = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # can't map an empty file
+            self.file.close()
+            raise WrongPakVer("Empty asset archive")
+
+        try:
+            self.read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def read_index(self):
+        """Read the metadata and file index from the end of the archive."""
+        if self.map[:len(pak_header)] != pak_header:
+            raise WrongPakVer("Unsupported asset archive format")
+
+        index_offset = unpack_from(">Q", self.map, len(pak_header))[0]
+        # copy out just the index, it's a tiny part of the whole file
+        data = self.map[index_offset:]
+        if data[:len(index_header)] != index_header:
+            raise WrongPakVer("Asset archive index is missing")
+        offset = len(index_header)
+
+        metadata = unpack_variant7(data[offset:])
+        self.metadata = dict(metadata[0])
+        offset += metadata[1]
+
+        file_count = unpack_vlq(data[offset:offset+10])
+        offset += file_count[1]
+
+        self.index = {}
+        for i in range(file_count[0]):
+            path_len = unpack_vlq(data[offset:offset+10])
+            offset += path_len[1]
+            path = data[offset:offset+path_len[0]].decode("utf-8")
+            offset += path_len[0]
+            self.index[path] = unpack_from(">QQ", data, offset)
+            offset += 16
+
+    def files(self):
+        """Return every asset path in the archive."""
+        return self.index.keys()
+
+    def exists(self, path):
+        return path in self.index
+
+    def size(self, path):
+        return self.index[path][1]
+
+    def read(self, path, size=-1):
+        """
+        Return the contents of an asset as bytes, or only the first size
+        bytes. Raises KeyError.
+        """
+        offset, length = self.index[path]
+        if size >= 0:
+            length = min(length, size)
+        return self.map[offset:offset+length]
+
+    def close(self):
+        if not self.map.closed:
+            self.map.close()
+        self.file.close()
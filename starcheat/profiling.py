@@ -0,0 +1,174 @@
+"""
+Profiling mode
+
+When turned on, the slow parts of starcheat (save decoding, indexing, DB
+queries, icons) are timed and counted, and a report is written on exit. It
+can also run cProfile over the whole session. When it's off the timers cost
+one flag check.
+"""
+
+import os, sys, time, threading, atexit, functools, io
+
+import config, logs
+
+log = logs.get_logger("profiling")
+
+# "no", "yes" for timers and counters, or "cprofile" to also run cProfile
+modes = ("no", "yes", "cprofile")
+enabled = False
+
+# stage name -> [calls, seconds, bytes]
+stages = {}
+# counter name -> count
+counters = {}
+lock = threading.Lock()
+
+profiler = None
+started = None
+
+def record(name, seconds, nbytes=0):
+    """Add one call of a stage to the report."""
+    with lock:
+        stage = stages.setdefault(name, [0, 0.0, 0])
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2] += nbytes
+
+def count(name, n=1):
+    """Add to a counter. Counters named "<x> hits" and "<x> misses" get a hit rate."""
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+class stage():
+    """
+    Context manager timing a block as a stage. Set nbytes on it to report
+    how much data the block decoded or encoded.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.nbytes = 0
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            record(self.name, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+def timed(name):
+    """Decorator timing every call of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def get_mode(argv):
+    """
+    Return the profiling mode from --profile or --profile=cprofile in argv,
+    falling back on the profile option. The argument is removed from argv.
+    """
+    for arg in list(argv[1:]):
+        if arg == "--profile" or arg.startswith("--profile="):
+            argv.remove(arg)
+            mode = arg.partition("=")[2] or "yes"
+            break
+    else:
+        try:
+            mode = config.Config().read().get("profile", config.profile)
+        except KeyError:
+            mode = config.profile
+
+    if mode not in modes:
+        log.warning("Unknown profile mode %s, expected one of %s", mode, ", ".join(modes))
+        return "no"
+    return mode
+
+def start(mode="yes"):
+    """Turn profiling on, the report is written when the process exits."""
+    global enabled, profiler, started
+    if mode == "no" or enabled:
+        return
+    enabled = True
+    started = time.perf_counter()
+
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    atexit.register(finish)
+
+def report():
+    """Return the report as text."""
+    lines = []
+    if started is not None:
+        lines.append("Session: %.2fs" % (time.perf_counter() - started))
+        lines.append("")
+
+    with lock:
+        lines.append("%-28s %8s %10s %10s %12s" % ("Stage", "Calls", "Total s", "Mean ms", "Bytes"))
+        for name in sorted(stages.keys(), key=lambda x: -stages[x][1]):
+            calls, seconds, nbytes = stages[name]
+            lines.append("%-28s %8d %10.3f %10.3f %12s" % (name, calls, seconds,
+                                                         seconds * 1000 / calls,
+                                                         nbytes if nbytes > 0 else ""))
+
+        if len(counters) > 0:
+            lines.append("")
+            lines.append("%-28s %8s" % ("Counter", "Count"))
+            for name in sorted(counters.keys()):
+                lines.append("%-28s %8d" % (name, counters[name]))
+
+            # hit rates for every hits/misses pair
+            for name in sorted(counters.keys()):
+                if not name.endswith(" hits"):
+                    continue
+                prefix = name[:-len(" hits")]
+                hits = counters[name]
+                total = hits + counters.get(prefix + " misses", 0)
+                lines.append("%s hit rate: %.1f%%" % (prefix, hits * 100.0 / total))
+
+    return "\n".join(lines) + "\n"
+
+def finish():
+    """Stop profiling and write the report next to the config file."""
+    global enabled, profiler
+    if not enabled:
+        return
+
+    text = report()
+    filename = os.path.join(config.config_folder, "profile.txt")
+    if profiler is not None:
+        profiler.disable()
+        import pstats
+        stats_file = os.path.join(config.config_folder, "profile.prof")
+        profiler.dump_stats(stats_file)
+
+        out = io.StringIO()
+        # only covers the main thread
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        text += "\ncProfile of the main thread (full stats in %s)\n%s" % (stats_file,
+                                                                          out.getvalue())
+        profiler = None
+
+    enabled = False
+    try:
+        with open(filename, "w") as f:
+            f.write(text)
+        sys.stderr.write("Profile report written to %s\n" % filename)
+    except OSError as e:
+        log.error("Couldn't write profile report: %s", e)
+        sys.stderr.write(text)
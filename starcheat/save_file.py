@@ -8,9 +8,13 @@ It can also be run from the command line to dump the contents, like this:
 $ python ./save_file.py <.player file>
 """
 
-import sys, binascii
+import sys, binascii, logging
 from struct import *
 
+import logs, profiling
+
+log = logs.get_logger("save")
+
 # compatible save versions
 data_version = range(424, 429)
 # this is the complete data format definition for a .player file. formats
@@ -165,6 +169,13 @@ def pack_str_list(var):
         str_list += pack_vlq_str(string)
     return pack_vlq(list_total) + str_list
 
+# nil, no data at all. these show up in packed asset metadata
+def unpack_variant1(data):
+    return None, 0
+
+def pack_variant1(var):
+    return b""
+
 # big endian double
 def unpack_variant2(data):
     # TODO: can these be plain pack()?
@@ -267,9 +278,7 @@ def unpack_blueprint_library(data):
 
 def pack_blueprint_library(var):
     blueprint_count = pack_vlq(len(var))
-    blueprints = b""
-    for blueprint in var:
-        blueprints += pack_item_desc(blueprint)
+    blueprints = b"".join([pack_item_desc(x) for x in var])
     blueprint_list = blueprint_count + blueprints
     return pack_vlq(len(blueprint_list)) + blueprint_list
 
@@ -385,8 +394,8 @@ save_file_types = {
 variant_types = (
     # unknown
     (None, None),
-    # unknown
-    (None, None),
+    # nil
+    (unpack_variant1, pack_variant1),
     # big endian double
     (unpack_variant2, pack_variant2),
     # boolean
@@ -405,14 +414,24 @@ class WrongSaveVer(Exception):
     pass
 
 class PlayerSave():
-    def __init__(self, filename):
+    def __init__(self, filename, until=None):
+        """
+        Load a player save file. until is the name of a value in data_format
+        to stop decoding after, for when only the start of the file is needed.
+        """
         self.data = {}
-        self.import_save(filename)
+        self.import_save(filename, until)
         self.filename = filename
 
-    def import_save(self, filename=None):
+    def import_save(self, filename=None, until=None):
+        with profiling.stage("save.import") as stage:
+            self.decode_save(filename, until, stage)
+
+    def decode_save(self, filename, until, stage):
         save_file = open(filename, mode="rb")
         save_data = save_file.read()
+        save_file.close()
+        stage.nbytes = len(save_data)
 
         # do a version check first
         version = unpack_from(data_format[1][1],
@@ -426,9 +445,14 @@ class PlayerSave():
             unpacked = unpack_var(var, save_data[offset:])
             self.data[var[0]] = unpacked[0]
             offset += unpacked[1]
-        save_file.close()
+            if var[0] == until:
+                break
 
     def export_save(self, filename=None):
+        with profiling.stage("save.export") as stage:
+            return self.encode_save(filename, stage)
+
+    def encode_save(self, filename, stage):
         player_data = b""
         for var in data_format[3:]:
             player_data += pack_var(var, self.data[var[0]])
@@ -438,6 +462,7 @@ class PlayerSave():
         global_vlq = pack_vlq(len(player_data))
         header_data = header + version + global_vlq
         file_data = header_data + player_data
+        stage.nbytes = len(file_data)
 
         if filename:
             save_file = open(filename, "wb")
@@ -447,9 +472,19 @@ class PlayerSave():
         else:
             return file_data
 
-    def dump(self):
+    def dump(self, out=None):
+        """
+        Print every value in the save to out (e.g. sys.stdout), or log them
+        if out isn't given, only if debug logging is on.
+        """
+        if out is not None:
+            for i in data_format:
+                print(i[0], ":", self.data[i[0]], file=out)
+            return
+        if not log.isEnabledFor(logging.DEBUG):
+            return
         for i in data_format:
-            print(i[0], ":", self.data[i[0]])
+            log.debug("%s: %r", i[0], self.data[i[0]])
 
     def get_uuid(self):
         raw_uuid = self.data["uuid"][1:]
@@ -574,6 +609,10 @@ class PlayerSave():
     def get_description(self):
         return self.data["description"]
 
+    def get_play_time(self):
+        """Return total play time in seconds."""
+        return self.data["play_time"][0]
+
     # blueprints are stored identically to inventory slots but as far as i've
     # seen there is never any variant data stored. let's just convert to a
     # regular list
@@ -637,4 +676,4 @@ class PlayerSave():
 
 if __name__ == '__main__':
     player = PlayerSave(sys.argv[1])
-    player.dump()
+    player.dump(sys.stdout)
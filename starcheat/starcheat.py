@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-import gui
-
 if __name__ == "__main__":
+    import sys, logs, profiling
+    logs.setup()
+    # --profile or --profile=cprofile, see profiling.py
+    profiling.start(profiling.get_mode(sys.argv))
+    # only pull in qt when actually starting the gui
+    import gui
     gui.MainWindow()